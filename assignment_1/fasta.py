@@ -0,0 +1,226 @@
+###############################################################################
+# Indexed FASTA access shared by ps1-dotplot.py and ps1-seqalign.py
+#
+# The file is memory-mapped and described by a samtools-style .fai index,
+# one line per record:
+#   name, length, offset of the first base, bases per line, bytes per line
+# which is written next to the FASTA file on first use. A subsequence is
+# located by arithmetic on the index, so fetching a window only reads the
+# bytes of that window.
+#
+# Files whose lines are not regularly wrapped have no such layout; their
+# records are read line by line into memory instead.
+#
+# Records are addressed by their number in the file, not by name, so
+# records with the same name (or several bare ">" headers) stay distinct.
+###############################################################################
+
+import os
+import mmap
+import numpy
+
+
+def scanFasta(data, filename="<fasta>"):
+    """returns the .fai entries (name, length, offset, linebases, linewidth)
+       of the FASTA text in data (a string or mmap); raises ValueError if
+       the lines are not regularly wrapped
+    """
+
+    entries = []
+    size = len(data)
+    pos = 0
+    record = None
+
+    while pos < size:
+        eol = data.find("\n", pos)
+        end = size if eol < 0 else eol + 1
+        line = data[pos:end]
+
+        if line.startswith(">"):
+            if record is not None:
+                entries.append(tuple(record[:5]))
+            header = line[1:].split()
+            # name, length, offset, linebases, linewidth, seen short/blank
+            record = [header[0] if header else "", 0, end, 0, 0, False]
+        elif record is None:
+            if line.strip():
+                raise ValueError("%s: sequence before the first header"
+                                 % filename)
+        else:
+            bases = len(line.rstrip())
+            if bases == 0:
+                record[5] = True
+            elif record[3] == 0 and record[5]:
+                raise ValueError("%s: blank line in record %s"
+                                 % (filename, record[0]))
+            elif record[3] == 0:
+                record[1], record[3], record[4] = bases, bases, len(line)
+            elif record[5] or bases > record[3] or (bases == record[3] and
+                    len(line) != record[4] and end != size):
+                # only the last line of a record may be short
+                raise ValueError("%s: irregular line lengths in record %s"
+                                 % (filename, record[0]))
+            else:
+                record[1] += bases
+                record[5] = bases < record[3]
+        pos = end
+
+    if record is not None:
+        entries.append(tuple(record[:5]))
+    return entries
+
+
+def parseFasta(data):
+    """returns the records of the FASTA text in data as a list of (name,
+       seq), each sequence the concatenation of its lines without trailing
+       whitespace; lines before the first header form a record named ""
+    """
+
+    records = []
+    name, seq = None, []
+    for line in data.splitlines():
+        if line.startswith(">"):
+            if name is not None or seq:
+                records.append((name or "", "".join(seq)))
+            header = line[1:].split()
+            name, seq = header[0] if header else "", []
+        else:
+            seq.append(line.rstrip())
+    if name is not None or seq:
+        records.append((name or "", "".join(seq)))
+    return records
+
+
+def readFai(filename):
+    """returns the entries of the .fai index of filename, or None if there
+       is none or it is older than the FASTA file"""
+
+    fai = filename + ".fai"
+    try:
+        if os.path.getmtime(fai) < os.path.getmtime(filename):
+            return None
+        entries = []
+        for line in open(fai):
+            fields = line.rstrip("\n").split("\t")
+            entries.append((fields[0],) + tuple(int(x) for x in fields[1:5]))
+        return entries
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def writeFai(filename, entries):
+    """writes the .fai index of filename; silently skipped if the directory
+       is not writable"""
+
+    try:
+        stream = open(filename + ".fai", "w")
+    except IOError:
+        return
+    for entry in entries:
+        stream.write("%s\t%d\t%d\t%d\t%d\n" % entry)
+    stream.close()
+
+
+class FastaFile(object):
+    """memory-mapped FASTA file with random access to its records, numbered
+       from 0 in file order"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        stream = open(filename, "rb")
+        size = os.fstat(stream.fileno()).st_size
+        if size:
+            self.data = mmap.mmap(stream.fileno(), size,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+        stream.close()
+
+        # records read into memory, if the file cannot be indexed
+        self.seqs = None
+        entries = readFai(filename)
+        if entries is None:
+            try:
+                entries = scanFasta(self.data, filename)
+            except ValueError:
+                records = parseFasta(self.data[:])
+                self.seqs = [seq for name, seq in records]
+                entries = [(name, len(seq), 0, 0, 0) for name, seq in records]
+            else:
+                writeFai(filename, entries)
+        self.names = [entry[0] for entry in entries]
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def length(self, k):
+        return self.entries[k][1]
+
+    def fetch(self, k, start=0, end=None):
+        """returns bases [start, end) of record k"""
+
+        name, length, offset, linebases, linewidth = self.entries[k]
+        start = max(0, start)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ""
+        if self.seqs is not None:
+            return self.seqs[k][start:end]
+
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last = offset + ((end-1) // linebases) * linewidth \
+            + (end-1) % linebases + 1
+        window = self.data[first:last]
+        if last - first != end - start:
+            # keep only the bytes in the base columns of each line
+            column = (numpy.arange(first, last) - offset) % linewidth
+            window = numpy.frombuffer(window, numpy.uint8)[column < linebases] \
+                .tostring()
+        return window
+
+    def record(self, k):
+        """returns a FastaRecord reading record k on demand"""
+        return FastaRecord(self, k)
+
+
+class FastaRecord(object):
+    """lazy view of one record: len() and slicing only read the bytes of
+       the requested window, str() reads the whole record"""
+
+    def __init__(self, fasta, k):
+        self.fasta = fasta
+        self.k = k
+        self.name = fasta.names[k]
+
+    def __len__(self):
+        return self.fasta.length(self.k)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, end, step = k.indices(len(self))
+            if step != 1:
+                return str(self)[k]
+            return self.fasta.fetch(self.k, start, end)
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(k)
+        return self.fasta.fetch(self.k, k, k+1)
+
+    def __str__(self):
+        return self.fasta.fetch(self.k)
+
+
+def readFasta(filename):
+    """returns the records of a FASTA file as a list of (name, seq)"""
+
+    fasta = FastaFile(filename)
+    return [(name, fasta.fetch(k)) for k, name in enumerate(fasta.names)]
+
+
+def readSeq(filename):
+    """reads in a FASTA sequence (all records concatenated)"""
+
+    fasta = FastaFile(filename)
+    return "".join(fasta.fetch(k) for k in xrange(len(fasta)))
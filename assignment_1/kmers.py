@@ -0,0 +1,470 @@
+###############################################################################
+# k-mer hashing shared by ps1-dotplot.py and ps1-seqalign.py
+#
+# A k-mer key at position i is the spaced seed seq[i+skip-1:i+kmerlen:skip],
+# i.e. every skip-th base of the kmerlen bases starting at i (skip=1 gives
+# plain contiguous k-mers).
+#
+# Keys are never built as strings. The bases are 2-bit codes (packedseq) and
+# the key of every window is an integer fingerprint
+#   sum over the w sampled bases c_t of c_t * B^(w-1-t)   (mod 2^64)
+# computed for all windows at once by doubling: the fingerprint of 2a bases
+# is the one of the first a bases times B^a plus the one of the next a. With
+# w <= 32 sampled bases B = 4 and the fingerprint is the exact 2-bit packing
+# of the key; longer keys use a random odd B, and hits are verified with a
+# second fingerprint using another B. Soft-masked (lowercase) bases are
+# hashed like uppercase ones; windows with any other non-ACGT base in the
+# key are not indexed.
+#
+# Keys are canonical: a window is hashed as the smaller of the fingerprint
+# of its key and of the key read on the other strand (the same window of
+# the reverse complement), both computed from the same codes. A window and
+# its inverted copy therefore get the same key, the index records which
+# strand each key was read on, and forward and inverted hits come out of a
+# single lookup with a strand flag. This needs a symmetric seed, one whose
+# sampled offsets are the same counted from either end of the window
+# (kmerlen % skip == skip-1, e.g. any contiguous seed): otherwise the two
+# strands sample different bases, so the index holds forward keys and the
+# keys of both strands of the query are looked up.
+#
+# The index is parallel arrays of fingerprints, positions and strands
+# sorted by fingerprint, so all the k-mers of a query are looked up at once
+# with searchsorted and the hits come out as int arrays.
+#
+# For long sequences the index can hold only the (w,k)-minimizers: of every
+# w consecutive k-mers, those whose mixed fingerprint is smallest (all of
+# them on ties, so the choice does not depend on the reading direction).
+# Two sequences sharing w+k-1 bases (on either strand) share the minimizers
+# of that window, so long matches are still found from about 2/(w+1) of the
+# positions, and their hits can be re-expanded to every k-mer hit on the
+# diagonal (anti-diagonal for inversions).
+#
+# An index can be written to a binary file: the header
+#   "KIDX", 4 unused bytes, then as little-endian uint64 kmerlen, skip,
+#   window, the number of entries, the bytes per position (4 or 8),
+#   whether second fingerprints are stored, and the length of the indexed
+#   sequence
+# followed by the fingerprints, the second fingerprints if any, the
+# positions, and one byte per entry set if the key was read on the reverse
+# strand. Loading memory-maps the file, so query runs start without
+# reading it and concurrent runs share its pages.
+###############################################################################
+
+import os
+import multiprocessing
+import numpy
+
+from packedseq import baseCodes
+
+
+# multipliers of the fingerprint, and of the second fingerprint hits are
+# checked with, when the key does not fit in 64 bits
+HASH_BASE = 0x9E3779B97F4A7C15
+CHECK_BASE = 0xC2B2AE3D27D4EB4F
+
+# multipliers of the mixing function ordering the keys for minimizers
+MIX_MULT = 0xBF58476D1CE4E5B9
+MIX_MULT2 = 0x94D049BB133111EB
+
+# k-mers of seq2 looked up per task of a parallel query
+QUERY_CHUNK = 1 << 18
+
+KIDX_MAGIC = "KIDX"
+KIDX_HEADER = 64
+
+
+_comp_table = "".join(
+    {'A':'T','C':'G','G':'C','T':'A','a':'T','c':'G','g':'C','t':'A'}
+    .get(chr(c), 'N') for c in xrange(256))
+
+
+def revcomp(seq):
+    return seq[::-1].translate(_comp_table)
+
+
+def seedWidth(kmerlen, skip=1):
+    """returns the number of bases sampled by a spaced seed"""
+    return len(xrange(skip-1, kmerlen, skip))
+
+
+def windowReduce(values, width, skip, combine):
+    """returns combine folded over values[i], values[i+skip], ...,
+       values[i+(width-1)*skip] for every i where that fits; combine(left,
+       right, rightwidth) joins the results for two adjacent runs
+    """
+
+    result, rwidth = None, 0
+    part, pwidth = values, 1
+    while True:
+        if width & pwidth:
+            if result is None:
+                result = part
+            else:
+                n = len(part) - rwidth*skip
+                result = combine(result[:n], part[rwidth*skip:], pwidth)
+            rwidth += pwidth
+        width &= ~pwidth
+        if not width:
+            return result
+        n = len(part) - pwidth*skip
+        part = combine(part[:n], part[pwidth*skip:], pwidth)
+        pwidth *= 2
+
+
+def fingerprints(seq, kmerlen, skip=1, base=None, reverse=False):
+    """returns (keys, valid, exact): the uint64 fingerprint of the key of
+       every window i in [0, len(seq)-kmerlen], whether that key is all
+       ACGT, and whether the fingerprints are exact (collision-free); base
+       overrides the multiplier B, and with reverse the keys are read on
+       the reverse strand
+    """
+
+    n = len(seq) - kmerlen + 1
+    w = seedWidth(kmerlen, skip)
+    exact = w <= 32 and base is None
+    if n <= 0 or w == 0:
+        return numpy.zeros(0, numpy.uint64), numpy.zeros(0, numpy.bool_), exact
+
+    codes = baseCodes(seq)
+    if reverse:
+        # complement of code c is 3 - c
+        codes = numpy.where(codes == 255, codes, 3 - codes)[::-1]
+    codes = codes[skip-1:]
+    bad = codes == 255
+    values = numpy.where(bad, 0, codes).astype(numpy.uint64)
+
+    if base is None:
+        base = 4 if exact else HASH_BASE
+    def combine(left, right, rwidth):
+        return left * numpy.uint64(pow(base, rwidth, 2**64)) + right
+    keys = windowReduce(values, w, skip, combine)[:n]
+    valid = ~windowReduce(bad, w, skip,
+                          lambda left, right, rwidth: left | right)[:n]
+    if reverse:
+        keys, valid = keys[::-1], valid[::-1]
+    return keys, valid, exact
+
+
+def symmetricSeed(kmerlen, skip=1):
+    """returns whether the spaced seed samples the same offsets of a window
+       counted from either end, so that the key read on the reverse strand
+       covers the same bases as the forward key"""
+    return kmerlen % skip == skip - 1
+
+
+def strandKeys(seq, kmerlen, skip=1, reverse=False):
+    """returns (keys, valid, check, flips) as keyArrays, for the keys of
+       every window read on the forward strand, or on the reverse strand
+       (all flips set) if reverse is set"""
+
+    keys, valid, exact = fingerprints(seq, kmerlen, skip, reverse=reverse)
+    check = None
+    if not exact:
+        check = fingerprints(seq, kmerlen, skip, CHECK_BASE, reverse)[0]
+    flips = numpy.zeros(len(keys), numpy.bool_)
+    flips.fill(reverse)
+    return keys, valid, check, flips
+
+
+def keyArrays(seq, kmerlen, skip=1):
+    """returns (keys, valid, check, flips): the canonical fingerprints and
+       validity of every window, the second fingerprints if the first are
+       not exact (else None), and whether each key was read on the reverse
+       strand; for a seed that is not symmetric (symmetricSeed) the keys
+       are those of the forward strand"""
+
+    if not symmetricSeed(kmerlen, skip):
+        return strandKeys(seq, kmerlen, skip)
+    keys, valid, exact = fingerprints(seq, kmerlen, skip)
+    rkeys = fingerprints(seq, kmerlen, skip, reverse=True)[0]
+    flips = rkeys < keys
+    keys = numpy.where(flips, rkeys, keys)
+    check = None
+    if not exact:
+        check = numpy.where(flips,
+            fingerprints(seq, kmerlen, skip, CHECK_BASE, reverse=True)[0],
+            fingerprints(seq, kmerlen, skip, CHECK_BASE)[0])
+    return keys, valid, check, flips
+
+
+def minimizers(keys, valid, window):
+    """returns the sorted positions of the (window, k)-minimizers: for every
+       run of window consecutive positions, the valid ones whose key has the
+       smallest mixed value; window=1 gives every valid position"""
+
+    if window == 1 or not len(keys):
+        return numpy.flatnonzero(valid)
+
+    # mixing spreads the minimizers over the sequence rather than on
+    # low-complexity keys such as poly-A, which has fingerprint 0
+    order = keys * numpy.uint64(MIX_MULT)
+    order ^= order >> numpy.uint64(31)
+    order *= numpy.uint64(MIX_MULT2)
+    order ^= order >> numpy.uint64(29)
+    order[~valid] = numpy.uint64(2**64 - 1)
+
+    # lowest[a] is the minimum of the run starting at a; a position is a
+    # minimizer if it equals the largest of those of the runs holding it
+    window = min(window, len(keys))
+    lowest = windowReduce(order, window, 1,
+                          lambda left, right, rwidth: numpy.minimum(left, right))
+    pad = numpy.zeros(window - 1, numpy.uint64)
+    highest = windowReduce(numpy.concatenate((pad, lowest, pad)), window, 1,
+                           lambda left, right, rwidth: numpy.maximum(left, right))
+    return numpy.flatnonzero((highest == order) & valid)
+
+
+class KmerIndex(object):
+    """sorted-array k-mer index: keys[k] is the canonical fingerprint of the
+       window starting at positions[k], read on the reverse strand if
+       flips[k], sorted by fingerprint and then position; for inexact
+       fingerprints check[k] is a second fingerprint of the same window.
+       With window > 1 only the (window, k)-minimizers are indexed; length
+       is the length of the indexed sequence."""
+
+    def __init__(self, kmerlen, skip, keys, positions, flips, check=None,
+                 window=1, length=0):
+        self.kmerlen = kmerlen
+        self.skip = skip
+        self.keys = keys
+        self.positions = positions
+        self.flips = flips
+        self.check = check
+        self.window = window
+        self.length = length
+
+    def __len__(self):
+        return len(self.keys)
+
+    def save(self, filename):
+        """writes the binary form to filename (atomically)"""
+
+        positions = numpy.asarray(self.positions)
+        posbytes = 8 if positions.dtype.itemsize > 4 else 4
+        tmp = filename + ".tmp%d" % os.getpid()
+        stream = open(tmp, "wb")
+        stream.write(KIDX_MAGIC + "\0" * 4)
+        stream.write(numpy.array([self.kmerlen, self.skip, self.window,
+                                  len(self), posbytes,
+                                  self.check is not None, self.length],
+                                 "<u8").tostring())
+        stream.write(numpy.asarray(self.keys, "<u8").tostring())
+        if self.check is not None:
+            stream.write(numpy.asarray(self.check, "<u8").tostring())
+        stream.write(positions.astype("<i%d" % posbytes).tostring())
+        stream.write(numpy.asarray(self.flips, numpy.uint8).tostring())
+        stream.close()
+        os.rename(tmp, filename)
+
+    def match(self, qkeys, qcheck=None):
+        """returns (q, k), two int arrays pairing every query key qkeys[q]
+           with each equal index key keys[k], ordered by q and then by
+           position"""
+
+        # searching in sorted order keeps the binary searches cache-friendly,
+        # and only keys that are present need their upper bound
+        if not len(self.keys):
+            qkeys = qkeys[:0]
+        order = numpy.argsort(qkeys)
+        lo = numpy.empty(len(qkeys), numpy.intp)
+        lo[order] = numpy.searchsorted(self.keys, qkeys[order], "left")
+        found = numpy.flatnonzero(self.keys.take(lo, mode="clip") == qkeys)
+        counts = numpy.zeros(len(qkeys), numpy.intp)
+        counts[found] = numpy.searchsorted(self.keys, qkeys[found],
+                                           "right") - lo[found]
+        q = numpy.repeat(numpy.arange(len(qkeys)), counts)
+        # k runs from lo[q] to hi[q]-1 within the run of each q
+        k = numpy.arange(len(q)) + numpy.repeat(lo - (numpy.cumsum(counts)
+                                                      - counts), counts)
+        if self.check is not None:
+            same = self.check[k] == qcheck[q]
+            q, k = q[same], k[same]
+        return q, k
+
+
+def buildIndex(seq, kmerlen, skip=1, window=1):
+    """returns a KmerIndex of every k-mer key of seq, or with window > 1 of
+       its (window, k)-minimizers only"""
+
+    keys, valid, check, flips = keyArrays(seq, kmerlen, skip)
+    dtype = numpy.int32 if len(seq) < 2**31 else numpy.int64
+    positions = minimizers(keys, valid, window).astype(dtype)
+    # stable, so equal keys stay in position order
+    order = numpy.argsort(keys[positions], kind="mergesort")
+    positions = positions[order]
+    if check is not None:
+        check = check[positions]
+    return KmerIndex(kmerlen, skip, keys[positions], positions,
+                     flips[positions], check, window, len(seq))
+
+
+def isIndexFile(filename):
+    """returns whether filename was written by KmerIndex.save"""
+
+    try:
+        return open(filename, "rb").read(4) == KIDX_MAGIC
+    except IOError:
+        return False
+
+
+def loadIndex(filename):
+    """returns the KmerIndex stored in filename by KmerIndex.save, as views
+       of a read-only memory map"""
+
+    data = numpy.memmap(filename, numpy.uint8, "r")
+    if data[:4].tostring() != KIDX_MAGIC:
+        raise ValueError("%s: not a k-mer index file" % filename)
+    kmerlen, skip, window, count, posbytes, hascheck, length = \
+        [int(x) for x in data[8:KIDX_HEADER].view("<u8")]
+    offset = KIDX_HEADER
+    keys = data[offset:offset + 8*count].view("<u8")
+    offset += 8*count
+    check = None
+    if hascheck:
+        check = data[offset:offset + 8*count].view("<u8")
+        offset += 8*count
+    positions = data[offset:offset + posbytes*count].view("<i%d" % posbytes)
+    offset += posbytes*count
+    flips = data[offset:offset + count].view(numpy.bool_)
+    return KmerIndex(kmerlen, skip, keys, positions, flips, check, window,
+                     length)
+
+
+def expandHits(j, i, inverted, target, query, window):
+    """returns every k-mer hit (j', i', inverted') within window-1 positions
+       of a hit (j, i) on the same diagonal, or anti-diagonal if inverted,
+       as three arrays without duplicates ordered by j' and then i'; target
+       and query are the keyArrays of the indexed and query sequences"""
+
+    keys1, valid1, check1, flips1 = target
+    keys2, valid2, check2, flips2 = query
+    offsets = numpy.arange(-(window - 1), window)
+    j = (j[:, None] + offsets).ravel()
+    i = (i[:, None] + numpy.where(inverted[:, None], -offsets, offsets)).ravel()
+    inverted = numpy.repeat(inverted, len(offsets))
+    inside = (j >= 0) & (j < len(keys2)) & (i >= 0) & (i < len(keys1))
+    j, i, inverted = j[inside], i[inside], inverted[inside]
+    same = valid2[j] & valid1[i] & (keys2[j] == keys1[i]) & \
+        ((flips2[j] != flips1[i]) == inverted)
+    if check1 is not None:
+        same &= check2[j] == check1[i]
+    j, i, inverted = j[same], i[same], inverted[same]
+
+    order = numpy.lexsort((i, j))
+    j, i, inverted = j[order], i[order], inverted[order]
+    new = numpy.ones(len(j), numpy.bool_)
+    new[1:] = (j[1:] != j[:-1]) | (i[1:] != i[:-1])
+    return j[new], i[new], inverted[new]
+
+
+def queryIndex(lookup, seq2, target=None, start=0, end=None):
+    """returns the hits of the k-mers of seq2 starting at positions
+       [start, end) in lookup as three arrays (index_in_seq2, index_in_seq1,
+       inverted), inverted being set where the two windows match on
+       opposite strands
+
+       For a minimizer index only the minimizers of seq2 are looked up; if
+       target, the keyArrays of the indexed sequence, is given the hits are
+       re-expanded to all k-mer matches on their diagonals.
+    """
+
+    kmerlen, skip, window = lookup.kmerlen, lookup.skip, lookup.window
+    n = max(0, len(seq2) - kmerlen + 1)
+    end = n if end is None else min(end, n)
+    # the minimizers within reach of [start, end) need the whole windows
+    # around them, and expansion reaches window-1 positions out
+    reach = window - 1 if target is not None else 0
+    lo = max(0, start - reach - (window - 1))
+    hi = min(n, end + reach + (window - 1))
+    part = baseCodes(seq2, lo, hi + kmerlen - 1)
+    if symmetricSeed(kmerlen, skip):
+        queries = [keyArrays(part, kmerlen, skip)]
+    else:
+        # the index holds forward keys only: look up the keys of both
+        # strands of seq2
+        queries = [strandKeys(part, kmerlen, skip),
+                   strandKeys(part, kmerlen, skip, reverse=True)]
+
+    hits = []
+    for query in queries:
+        keys, valid, check, flips = query
+        starts = minimizers(keys, valid, window)
+        starts = starts[(starts >= start - reach - lo) &
+                        (starts < end + reach - lo)]
+
+        qcheck = None
+        if lookup.check is not None:
+            qcheck = check[starts]
+        q, k = lookup.match(keys[starts], qcheck)
+        j = starts[q]
+        i = lookup.positions[k].astype(numpy.int64)
+        inverted = lookup.flips[k] != flips[j]
+        if window > 1 and target is not None:
+            j, i, inverted = expandHits(j, i, inverted, target, query, window)
+            inside = (j >= start - lo) & (j < end - lo)
+            j, i, inverted = j[inside], i[inside], inverted[inside]
+        hits.append((j, i, inverted))
+
+    j, i, inverted = [numpy.concatenate(arrays) for arrays in zip(*hits)]
+    if len(hits) > 1:
+        order = numpy.lexsort((i, j))
+        j, i, inverted = j[order], i[order], inverted[order]
+    return j + lo, i, inverted
+
+
+# (lookup, target, seq2) of the current query, set in each worker
+_query = None
+
+def _queryInit(lookup, target, seq2):
+    global _query
+    _query = (lookup, target, seq2)
+
+def _queryChunk(bounds):
+    lookup, target, seq2 = _query
+    return queryIndex(lookup, seq2, target, *bounds)
+
+
+def findHits(lookup, seq2, kmerlen, skip=1, inversions=True, seq1=None,
+             procs=1, chunk=QUERY_CHUNK):
+    """looks up the k-mers of seq2 in an index built by buildIndex with the
+       same kmerlen and skip; both strands are matched in one pass, and
+       hits between opposite strands are dropped unless inversions is set
+
+       With a minimizer index (window > 1) the hits are those of the shared
+       minimizers, which include at least one hit of every match of
+       window + kmerlen - 1 bases or more; passing seq1, the indexed
+       sequence, re-expands them to all the k-mer hits near them.
+
+       The query is split into chunks of chunk k-mers (chunk + kmerlen - 1
+       bases, overlapping by kmerlen - 1) looked up on procs processes (all
+       cores if None), which share the index and sequences by fork.
+
+       returns three arrays of equal length
+       ([index1_in_seq2, index2_in_seq2, ...],
+        [index1_in_seq1, index2_in_seq1, ...],
+        [inverted1, inverted2, ...])
+    """
+
+    assert (kmerlen, skip) == (lookup.kmerlen, lookup.skip)
+    target = None
+    if seq1 is not None and lookup.window > 1:
+        target = keyArrays(seq1, kmerlen, skip)
+    n = max(0, len(seq2) - kmerlen + 1)
+    tasks = [(start, start + chunk) for start in xrange(0, n, chunk)]
+
+    if procs == 1 or len(tasks) <= 1:
+        _queryInit(lookup, target, seq2)
+        hits = map(_queryChunk, tasks)
+    else:
+        pool = multiprocessing.Pool(procs, _queryInit, (lookup, target, seq2))
+        try:
+            hits = pool.map(_queryChunk, tasks, 1)
+        finally:
+            pool.terminate()
+            pool.join()
+    hits.append((numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64),
+                 numpy.zeros(0, numpy.bool_)))
+    j, i, inverted = [numpy.concatenate(arrays) for arrays in zip(*hits)]
+    if not inversions:
+        j, i, inverted = j[~inverted], i[~inverted], inverted[~inverted]
+    return j, i, inverted
@@ -0,0 +1,176 @@
+###############################################################################
+# 2-bit packed DNA sequences shared by the assignment scripts
+#
+# Bases are coded in base_idx order (A=0, G=1, C=2, T=3, the row order of
+# the substitution and emission matrices), so the complement of code c is
+# 3 - c. Lowercase (soft-masked) bases get the same codes as uppercase ones.
+# Four codes are packed per byte, first base in the low bits. Any other
+# character (N, IUPAC codes) is stored as code 0 with its position set in a
+# separate bit mask.
+#
+# A PackedSeq can be written to a small binary file: the header
+#   "PSEQ", 4 unused bytes, the length as little-endian uint64
+# followed by the packed codes and then the mask. Loading memory-maps the
+# file, so only the pages of the windows actually read are touched.
+###############################################################################
+
+import os
+import numpy
+
+from fasta import readSeq
+
+
+BASES = "AGCT"
+base_idx = dict((base, k) for k, base in enumerate(BASES))
+
+PSEQ_MAGIC = "PSEQ"
+PSEQ_HEADER = 16
+
+_code_table = numpy.empty(256, numpy.uint8)
+_code_table.fill(255)
+for _base, _idx in base_idx.items():
+    _code_table[ord(_base)] = _idx
+    _code_table[ord(_base.lower())] = _idx
+
+_shifts = numpy.arange(0, 8, 2, dtype=numpy.uint8)
+
+
+def baseCodes(seq, start=0, end=None):
+    """returns the uint8 base_idx codes of bases [start, end) of seq (a
+       string, PackedSeq or array of codes), with 255 at every character
+       other than A, C, G, T in either case"""
+
+    if isinstance(seq, numpy.ndarray):
+        return seq[start:end]
+    if isinstance(seq, PackedSeq):
+        codes = seq.codes(start, end)
+        if seq.ncount:
+            codes[seq.mask(start, end)] = 255
+        return codes
+    return _code_table[numpy.frombuffer(seq, numpy.uint8)[start:end]]
+
+
+def encodeSeq(seq):
+    """returns seq (a string or PackedSeq) as a numpy uint8 array of base_idx
+       codes; raises KeyError on anything but A, C, G, T in either case"""
+
+    if isinstance(seq, PackedSeq):
+        if seq.ncount:
+            raise KeyError("N")
+        return seq.codes()
+    codes = baseCodes(seq)
+    if (codes == 255).any():
+        raise KeyError(seq[int(numpy.argmax(codes == 255))])
+    return codes
+
+
+def packSeq(seq):
+    """returns seq (a string) as a PackedSeq"""
+
+    codes = baseCodes(seq)
+    nmask = codes == 255
+    codes[nmask] = 0
+    return PackedSeq(packCodes(codes), numpy.packbits(nmask), len(seq))
+
+
+def packCodes(codes):
+    """returns the uint8 codes packed four per byte"""
+
+    padded = numpy.zeros(-(-len(codes) // 4) * 4, numpy.uint8)
+    padded[:len(codes)] = codes
+    return numpy.bitwise_or.reduce(padded.reshape(-1, 4) << _shifts, axis=1) \
+        .astype(numpy.uint8)
+
+
+class PackedSeq(object):
+    """DNA sequence of length bases stored as 2-bit codes (packed) plus a
+       bit mask of the non-ACGT positions (nmask, numpy.packbits order)"""
+
+    def __init__(self, packed, nmask, length):
+        self.packed = packed
+        self.nmask = nmask
+        self.length = length
+        self.ncount = int(numpy.unpackbits(nmask).sum()) if length else 0
+
+    def __len__(self):
+        return self.length
+
+    def window(self, start, end):
+        start = max(0, start)
+        end = self.length if end is None else min(end, self.length)
+        return start, max(start, end)
+
+    def codes(self, start=0, end=None):
+        """returns the uint8 codes of bases [start, end), unpacking only the
+           bytes that hold them; masked positions read as 0"""
+
+        start, end = self.window(start, end)
+        first = start // 4
+        chunk = self.packed[first:-(-end // 4)]
+        codes = ((chunk[:, None] >> _shifts) & 3).reshape(-1)
+        return codes[start - 4*first:end - 4*first]
+
+    def mask(self, start=0, end=None):
+        """returns a bool array, True at the non-ACGT positions in
+           [start, end)"""
+
+        start, end = self.window(start, end)
+        first = start // 8
+        bits = numpy.unpackbits(self.nmask[first:-(-end // 8)])
+        return bits[start - 8*first:end - 8*first].astype(numpy.bool_)
+
+    def decode(self, start=0, end=None):
+        """returns bases [start, end) as a string, with N at masked
+           positions"""
+
+        letters = numpy.frombuffer(BASES, numpy.uint8)[self.codes(start, end)]
+        if self.ncount:
+            letters[self.mask(start, end)] = ord("N")
+        return letters.tostring()
+
+    def __str__(self):
+        return self.decode()
+
+    def save(self, filename):
+        """writes the binary form to filename (atomically)"""
+
+        tmp = filename + ".tmp%d" % os.getpid()
+        stream = open(tmp, "wb")
+        stream.write(PSEQ_MAGIC + "\0" * 4)
+        stream.write(numpy.array([self.length], "<u8").tostring())
+        stream.write(numpy.asarray(self.packed).tostring())
+        stream.write(numpy.asarray(self.nmask).tostring())
+        stream.close()
+        os.rename(tmp, filename)
+
+
+def loadPacked(filename):
+    """returns the PackedSeq stored in filename by PackedSeq.save, as views
+       of a read-only memory map"""
+
+    data = numpy.memmap(filename, numpy.uint8, "r")
+    if data[:4].tostring() != PSEQ_MAGIC:
+        raise ValueError("%s: not a packed sequence file" % filename)
+    length = int(data[8:PSEQ_HEADER].view("<u8")[0])
+    npacked = -(-length // 4)
+    packed = data[PSEQ_HEADER:PSEQ_HEADER + npacked]
+    nmask = data[PSEQ_HEADER + npacked:PSEQ_HEADER + npacked + -(-length // 8)]
+    return PackedSeq(packed, nmask, length)
+
+
+def readPacked(filename):
+    """returns readSeq(filename) as a PackedSeq, cached next to the FASTA
+       file as filename.pseq and reloaded from there while it is newer"""
+
+    cache = filename + ".pseq"
+    try:
+        if os.path.getmtime(cache) >= os.path.getmtime(filename):
+            return loadPacked(cache)
+    except (OSError, ValueError):
+        pass
+    pseq = packSeq(readSeq(filename))
+    try:
+        pseq.save(cache)
+    except (IOError, OSError):
+        pass
+    return pseq
@@ -5,9 +5,31 @@
 #
 # INSTRUCTIONS FOR USE:
 # call program as follows:
-#  ./ps1-dotplot.py <FASTA 1> <FASTA 2> <PLOTFILE>
+#  ./ps1-dotplot.py <FASTA 1> <FASTA 2> <PLOTFILE> [WINDOW] [PROCS]
 #     e.g. ./ps1-dotplot.py human-hoxa-region.fa mouse-hoxa-region.fa dotplot.jpg
 #
+# With WINDOW > 1 only the (WINDOW, k)-minimizers of the sequences are
+# hashed, which makes the index about (WINDOW+1)/2 times smaller for large
+# genomes; every match of WINDOW + k - 1 bases or more is still plotted.
+# The k-mers of FASTA 2 are looked up in chunks on PROCS processes (all
+# cores by default).
+#
+# To compare one sequence against many, hash it once into an index file:
+#  ./ps1-dotplot.py build-index <FASTA 1> <INDEX FILE> [WINDOW]
+# and pass the INDEX FILE in place of FASTA 1. The index is memory-mapped
+# rather than read, so such runs only hash FASTA 2. (Minimizer hits are
+# then plotted as they are, since expanding them needs FASTA 1.)
+#
+# The sequences are held as 2-bit packed codes (packedseq.py), and each
+# FASTA file is cached next to it as FASTA.pseq, so later runs memory-map
+# that instead of parsing the FASTA again.
+#
+# For dense comparisons, --raster (before the other arguments) bins the hits
+# into a grid of at most RASTER_SIZE x RASTER_SIZE cells instead of drawing
+# them one by one. A PLOTFILE ending in .pgm or .png is written directly as
+# a grey-scale image (darker = more hits, no axes, gnuplot not needed);
+# other formats are drawn by gnuplot from the grid as one binary matrix.
+#
 # Make sure the ps1-dotplot.py is marked as executable:
 #     chmod +x ps1-dotplot.py
 # or in windows with:
@@ -37,74 +59,204 @@
 
 
 
-import sys, random
+import sys, random, struct, zlib
+import numpy
 import plotting
+from kmers import buildIndex, findHits, isIndexFile, loadIndex
+from packedseq import readPacked
 
 
-def readSeq(filename):
-    """reads in a FASTA sequence"""
-
-    stream = open(filename)
-    seq = []
-
-    for line in stream:
-        if line.startswith(">"):
-            continue
-        seq.append(line.rstrip())
+# cells along the longer side of a rasterized dotplot
+RASTER_SIZE = 1000
 
-    return "".join(seq)
 
+def chainHits(hits, kmerlen, gap=None):
+    """chains hits (arrays, as returned by findHits) into segments: runs of
+       hits on one diagonal (anti-diagonal for inversions) at most gap bases
+       apart in seq2 (kmerlen by default)
 
-def revcomp(seq):
-    comp = {'A':'T','C':'G','G':'C','T':'A','a':'T','c':'G','g':'C','t':'A'}
-    return "".join(comp.get(b, 'N') for b in seq[::-1])
-
-def quality(hits):
-    """determines the quality of a list of hits"""
+       returns the segments as arrays
+       (x1, y1, x2, y2, inverted, count)
+       where (x1, y1) and (x2, y2) are the ends of the matched bases in
+       (seq2, seq1) coordinates and count is the number of hits merged
+    """
+    if gap is None:
+        gap = kmerlen
+    x, y, inverted = hits
+    diagonal = numpy.where(inverted, y + x, y - x)
+    order = numpy.lexsort((x, diagonal, inverted))
+    x, y, diagonal, inverted = \
+        x[order], y[order], diagonal[order], inverted[order]
+
+    # a segment starts at each new strand or diagonal, or after a gap
+    start = numpy.ones(len(x), numpy.bool_)
+    start[1:] = (inverted[1:] != inverted[:-1]) | \
+        (diagonal[1:] != diagonal[:-1]) | (x[1:] - x[:-1] > gap)
+    first = numpy.flatnonzero(start)
+    last = numpy.append(first, len(x))[1:] - 1
+    inverted = inverted[first]
+
+    # an inverted run goes down seq1 as it goes up seq2
+    y1 = numpy.where(inverted, y[first] + kmerlen, y[first])
+    y2 = numpy.where(inverted, y[last], y[last] + kmerlen)
+    return (x[first], y1, x[last] + kmerlen, y2, inverted, last - first + 1)
+
+
+def quality(segments):
+    """determines the quality of segments (as returned by chainHits):
+       returns the number of hits of the segments whose midpoint lies
+       between the two diagonal lines"""
 
     slope1 = 1.0e6 / (825000 - 48000)
     slope2 = 1.0e6 / (914000 - 141000)
     offset1 = 0 - slope1*48000
     offset2 = 0 - slope2*141000
 
-    goodhits = []
-
-    for hit in hits:
-        upper = slope1 * hit[0] + offset1
-        lower = slope2 * hit[0] + offset2
+    x1, y1, x2, y2, inverted, count = segments
+    x = (x1 + x2) / 2.0
+    y = (y1 + y2) / 2.0
+    upper = slope1 * x + offset1
+    lower = slope2 * x + offset2
+    good = (lower < y) & (y < upper)
 
-        if lower < hit[1] < upper:
-            goodhits.append(hit)
+    return int(count[good].sum())
 
-    return goodhits
 
-
-def makeDotplot(filename, hits):
-    """generate a dotplot from a list of hits
+def makeDotplot(filename, segments):
+    """generate a dotplot from segments (as returned by chainHits)
        filename may end in the following file extensions:
          *.ps, *.png, *.jpg
     """
-    x, y = zip(* hits)
+    x1, y1, x2, y2, inverted, count = segments
+    nhits = int(count.sum())
+
+    # one line per segment, separated by undefined points
+    nan = numpy.empty(len(x1))
+    nan.fill(numpy.nan)
+    x = numpy.column_stack((x1, x2, nan)).ravel().tolist()
+    y = numpy.column_stack((y1, y2, nan)).ravel().tolist()
 
     slope1 = 1.0e6 / (825000 - 48000)
     slope2 = 1.0e6 / (914000 - 141000)
     offset1 = 0 - slope1*48000
     offset2 = 0 - slope2*141000
 
-    hits2 = quality(hits)
-    print "%.5f%% hits on diagonal" % (100 * len(hits2) / float(len(hits)))
+    ngood = quality(segments)
+    print "%.5f%% hits on diagonal" % (100 * ngood / float(max(nhits, 1)))
 
     # create plot
     p = plotting.Gnuplot()
     p.enableOutput(False)
-    p.plot(x, y, xlab="sequence 2", ylab="sequence 1")
+    p.plot(x, y, style="lines", xlab="sequence 2", ylab="sequence 1")
     p.plotfunc(lambda x: slope1 * x + offset1, 0, 1e6, 1e5)
     p.plotfunc(lambda x: slope2 * x + offset2, 0, 1e6, 1e5)
 
     # set plot labels
     p.set(xmin=0, xmax=1e6, ymin=0, ymax=1e6)
-    p.set(main="dotplot (%d hits, %.5f%% hits on diagonal)" %
-          (len(hits), 100 * len(hits2) / float(len(hits))))
+    p.set(main="dotplot (%d hits in %d segments, %.5f%% hits on diagonal)" %
+          (nhits, len(x1), 100 * ngood / float(max(nhits, 1))))
+    p.enableOutput(True)
+
+    # output plot
+    p.save(filename)
+
+    return p
+
+
+def rasterize(hits, width, height, size=RASTER_SIZE):
+    """bins hits (arrays, as returned by findHits) of a width x height
+       comparison (lengths of seq2 and seq1) into square cells
+
+       returns (grid, binsize) where grid[r, c] counts the hits with
+       index_in_seq1 // binsize == r and index_in_seq2 // binsize == c
+    """
+    binsize = max(1, -(-max(width, height) // size))
+    ncols = max(1, -(-width // binsize))
+    nrows = max(1, -(-height // binsize))
+
+    x, y = hits[0] // binsize, hits[1] // binsize
+    inside = (x < ncols) & (y < nrows)
+    cells = y[inside] * ncols + x[inside]
+    grid = numpy.bincount(cells, minlength=nrows * ncols)
+    return grid.reshape(nrows, ncols), binsize
+
+
+def shade(grid):
+    """returns grid as uint8 grey levels, white for empty cells and darker
+       with the log of the count, first row at the top"""
+    top = max(1, int(grid.max()))
+    level = numpy.log1p(grid) / numpy.log1p(top)
+    return (255 - numpy.round(255 * level)).astype(numpy.uint8)[::-1]
+
+
+def writePGM(filename, pixels):
+    """writes uint8 pixels as a binary PGM image"""
+    stream = open(filename, "wb")
+    stream.write("P5\n%d %d\n255\n" % (pixels.shape[1], pixels.shape[0]))
+    stream.write(numpy.ascontiguousarray(pixels).tostring())
+    stream.close()
+
+
+def writePNG(filename, pixels):
+    """writes uint8 pixels as a grey-scale PNG image"""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + \
+            struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    nrows, ncols = pixels.shape
+    # each row is preceded by its filter type, 0 (none)
+    rows = numpy.zeros((nrows, ncols + 1), numpy.uint8)
+    rows[:, 1:] = pixels
+    stream = open(filename, "wb")
+    stream.write("\x89PNG\r\n\x1a\n")
+    stream.write(chunk("IHDR", struct.pack(">IIBBBBB", ncols, nrows,
+                                           8, 0, 0, 0, 0)))
+    stream.write(chunk("IDAT", zlib.compress(rows.tostring(), 6)))
+    stream.write(chunk("IEND", ""))
+    stream.close()
+
+
+def makeRasterDotplot(filename, hits, width, height):
+    """generate a dotplot of the density of hits (arrays, as returned by
+       findHits) of a width x height comparison (lengths of seq2 and seq1)
+       filename may end in the following file extensions:
+         *.pgm, *.png (written directly), *.ps, *.jpg (via gnuplot)
+    """
+    grid, binsize = rasterize(hits, width, height)
+    print "%d x %d cells of %d bases" % (grid.shape[1], grid.shape[0], binsize)
+
+    if filename.endswith(".pgm"):
+        writePGM(filename, shade(grid))
+        return None
+    if filename.endswith(".png"):
+        writePNG(filename, shade(grid))
+        return None
+
+    # one binary matrix, with the cell centers as coordinates
+    matrixfile = "tmpplot.bin"
+    numpy.log1p(grid).astype("<f4").tofile(matrixfile)
+    matrix = "'%s' binary array=(%d,%d) dx=%d dy=%d origin=(%g,%g) " \
+             "format='%%float32' endian=little" % \
+             (matrixfile, grid.shape[1], grid.shape[0], binsize, binsize,
+              binsize / 2.0, binsize / 2.0)
+
+    slope1 = 1.0e6 / (825000 - 48000)
+    slope2 = 1.0e6 / (914000 - 141000)
+    offset1 = 0 - slope1*48000
+    offset2 = 0 - slope2*141000
+
+    # create plot
+    p = plotting.Gnuplot()
+    p.enableOutput(False)
+    p.plot([0], [0], eqn=matrix, style="image",
+           xlab="sequence 2", ylab="sequence 1")
+    p.plotfunc(lambda x: slope1 * x + offset1, 0, 1e6, 1e5, eqn=None)
+    p.plotfunc(lambda x: slope2 * x + offset2, 0, 1e6, 1e5, eqn=None)
+
+    # set plot labels
+    p.set(xmin=0, xmax=width, ymin=0, ymax=height)
+    p.set(main="dotplot density (%d hits, %d bases per cell)" %
+          (len(hits[0]), binsize))
     p.enableOutput(True)
 
     # output plot
@@ -125,68 +277,89 @@ def main():
     # plotfile = "dotplot.jpg"
 
     # parse command-line arguments
+    raster = "--raster" in sys.argv[1:]
+    if raster:
+        sys.argv.remove("--raster")
     if len(sys.argv) < 4:
         print "you must call program as:  "
-        print "   python ps1-dotplot.py <FASTA 1> <FASTA 2> <PLOT FILE>"
-        print "   PLOT FILE may be *.ps, *.png, *.jpg"
+        print "   python ps1-dotplot.py [--raster] <FASTA 1> <FASTA 2> <PLOT FILE> [WINDOW] [PROCS]"
+        print "   python ps1-dotplot.py build-index <FASTA 1> <INDEX FILE> [WINDOW]"
+        print "   PLOT FILE may be *.ps, *.png, *.jpg (or *.pgm with --raster)"
+        print "   --raster plots the density of hits on a fixed grid"
+        print "   WINDOW > 1 hashes only minimizers of WINDOW k-mers"
+        print "   PROCS is the number of lookup processes (default: all cores)"
+        print "   FASTA 1 may be an INDEX FILE written by build-index"
         sys.exit(1)
-    file1 = sys.argv[1]
-    file2 = sys.argv[2]
-    plotfile = sys.argv[3]
-
-
-
-    # read sequences
-    print "reading sequences"
-    seq1 = readSeq(file1)
-    seq2 = readSeq(file2)
+    build = sys.argv[1] == "build-index"
+    args = sys.argv[2:] if build else sys.argv[1:]
+    file1 = args[0]
+    file2 = args[1]
+    if build:
+        indexfile = args[1]
+        window = int(args[2]) if len(args) > 2 else 1
+    else:
+        plotfile = args[2]
+        window = int(args[3]) if len(args) > 3 else 1
+        procs = int(args[4]) if len(args) > 4 else None
 
 
     # length of hash key
     kmerlen = 120
     skip=4
-    
 
-    # hash table for finding hits
-    lookup = {}
 
-    # store sequence hashes in hash table
-    print "hashing seq1..."
-    for i in xrange(len(seq1) - kmerlen + 1):
-        key = seq1[i+skip-1:i+kmerlen:skip]
-        lookup.setdefault(key, []).append(i)
+    if build:
+        print "hashing seq1..."
+        buildIndex(readPacked(file1), kmerlen, skip, window).save(indexfile)
+        print "index written to %s" % indexfile
+        return
 
 
+    # read sequences
+    print "reading sequences"
+    if isIndexFile(file1):
+        seq1 = None
+    else:
+        seq1 = readPacked(file1)
+    seq2 = readPacked(file2)
 
-    # look up hashes in hash table
+
+    # store sequence hashes in hash table
+    if seq1 is None:
+        print "loading index of seq1..."
+        lookup = loadIndex(file1)
+        kmerlen, skip = lookup.kmerlen, lookup.skip
+    else:
+        print "hashing seq1..."
+        lookup = buildIndex(seq1, kmerlen, skip, window)
+
+    # look up hashes in hash table (minimizer hits are expanded back to
+    # every k-mer hit around them)
     print "hashing seq2..."
-    hits = []
-    for i in xrange(len(seq2) - kmerlen + 1):
-        key = seq2[i+skip-1:i+kmerlen:skip]
-
-        # store hits to hits list
-        for hit in lookup.get(key, []):
-            hits.append((i, hit))
-
-    
-    rc2 = revcomp(seq2)
-    for i_rc in xrange(len(rc2) - kmerlen + 1):
-        key = rc2[i_rc:i_rc+kmerlen]
-      
-        i_orig = len(seq2) - kmerlen - i_rc
-        for hit in lookup.get(key, []):
-            hits.append((i_orig, hit))
+    hits = findHits(lookup, seq2, kmerlen, skip, seq1=seq1, procs=procs)
 
     #
-    # hits should be a list of tuples
-    # [(index1_in_seq2, index1_in_seq1),
-    #  (index2_in_seq2, index2_in_seq1),
-    #  ...]
+    # hits should be three arrays of equal length
+    # ([index1_in_seq2, index2_in_seq2, ...],
+    #  [index1_in_seq1, index2_in_seq1, ...],
+    #  [inverted1, inverted2, ...])
     #
 
-    print "%d hits found (forward + inversion)" % len(hits)
+    ninverted = int(hits[2].sum())
+    print "%d hits found (%d forward + %d inversion)" % \
+        (len(hits[0]), len(hits[0]) - ninverted, ninverted)
+
+    if raster:
+        print "making plot..."
+        p = makeRasterDotplot(plotfile, hits, len(seq2), lookup.length)
+        return
+
+    print "chaining hits..."
+    segments = chainHits(hits, kmerlen)
+    print "%d segments" % len(segments[0])
+
     print "making plot..."
-    p = makeDotplot(plotfile, hits)
+    p = makeDotplot(plotfile, segments)
 
 
 main()
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
-import sys
+import sys, os, re, optparse, bisect, itertools, multiprocessing
+import hashlib, tempfile, fcntl, math, random
+import numpy
+from kmers import buildIndex, findHits
+from fasta import readSeq, readFasta
+from packedseq import encodeSeq
 
 base_idx = { 'A' : 0, 'G' : 1, 'C' : 2, 'T' : 3 }
 PTR_NONE, PTR_GAP1, PTR_GAP2, PTR_BASE = 0, 1, 2, 3
@@ -52,42 +57,1574 @@ def seqalignDP(seq1,seq2,subst_matrix,gap_pen):
 	return F[len(seq1)][len(seq2)], F, TB
 
 def traceback(seq1,seq2,TB):
-	s1 = ""
-	s2 = ""
+	s1 = []
+	s2 = []
 
+	for piece1, piece2 in alignedPieces(seq1,seq2,tracebackOps(seq1,seq2,TB)):
+		s1.append(piece1)
+		s2.append(piece2)
+
+	return "".join(s1),"".join(s2)
+
+def tbAccessor(TB):
+	"""return a function get(i, j) reading pointer [i][j] of TB, which may be
+	   a list of lists, a numpy array or a table object with a get method
+	"""
+	if isinstance(TB, numpy.ndarray):
+		return TB.item
+	if hasattr(TB, "get"):
+		return TB.get
+	return lambda i, j: TB[i][j]
+
+###############################################################################
+# ALIGNMENT OPERATIONS (CIGAR)
+# An alignment can be kept as run-length encoded operations instead of two
+# gapped strings, with seq1 as the reference: M aligns a base of seq1 with a
+# base of seq2, I is a base of seq2 against a gap and D a base of seq1
+# against a gap. The gapped strings are only rendered on output.
+###############################################################################
+
+PTR_OP = { PTR_BASE : 'M', PTR_GAP1 : 'I', PTR_GAP2 : 'D' }
+
+def tracebackOps(seq1,seq2,TB):
+	"""return the alignment traced back through TB as a list of (op, count)
+	   runs, first run first
+	"""
+	get = tbAccessor(TB)
 	i = len(seq1)
 	j = len(seq2)
 
-	while TB[i][j] != PTR_NONE:
-		if TB[i][j] == PTR_BASE:
-			s1 = seq1[i-1] + s1
-			s2 = seq2[j-1] + s2
-			i=i-1
-			j=j-1
-		elif TB[i][j] == PTR_GAP1:
-			s1 = '-' + s1
-			s2 = seq2[j-1] + s2
-			j=j-1
-	   	elif TB[i][j] == PTR_GAP2:
-			s1 = seq1[i-1] + s1
-			s2 = '-' + s2
-			i=i-1
+	runs = []
+	ptr = get(i,j)
+	while ptr != PTR_NONE:
+		if runs and runs[-1][0] == ptr:
+			runs[-1][1] += 1
+		else:
+			runs.append([ptr, 1])
+		if ptr == PTR_BASE:
+			i, j = i-1, j-1
+		elif ptr == PTR_GAP1:
+			j = j-1
+		elif ptr == PTR_GAP2:
+			i = i-1
 		else: assert False
+		ptr = get(i,j)
+
+	runs.reverse()
+	return [(PTR_OP[ptr], count) for ptr, count in runs]
+
+def stringsToOps(s1,s2):
+	"""return the (op, count) runs of an alignment given as gapped strings"""
+	ops = []
+	for gap1, gap2 in itertools.izip(s1, s2):
+		op = 'I' if gap1 == '-' else 'D' if gap2 == '-' else 'M'
+		if ops and ops[-1][0] == op:
+			ops[-1][1] += 1
+		else:
+			ops.append([op, 1])
+	return [(op, count) for op, count in ops]
+
+def opsToCigar(ops):
+	"""return ops as a CIGAR string, e.g. 12M2I30M1D5M"""
+	return "".join("%d%s" % (count, op) for op, count in ops)
+
+def cigarToOps(cigar):
+	"""return the (op, count) runs of a CIGAR string written by opsToCigar"""
+	return [(op, int(count)) for count, op in re.findall(r"(\d+)([MID])", cigar)]
+
+def alignedPieces(seq1,seq2,ops):
+	"""yield the gapped strings of an alignment piece by piece, as one
+	   (piece1, piece2) pair per run of ops
+	"""
+	i = j = 0
+	for op, count in ops:
+		if op == 'M':
+			yield seq1[i:i+count], seq2[j:j+count]
+			i, j = i+count, j+count
+		elif op == 'I':
+			yield '-' * count, seq2[j:j+count]
+			j = j+count
+		else:
+			yield seq1[i:i+count], '-' * count
+			i = i+count
+
+def writeAlignment(seq1,seq2,ops,stream=sys.stdout,width=0):
+	"""write the gapped strings of an alignment to stream without building
+	   them in memory: as two lines, or with width > 0 in blocks of width
+	   columns (s1 line, s2 line, blank line)
+	"""
+	if not width:
+		for k in (0, 1):
+			for pieces in alignedPieces(seq1,seq2,ops):
+				stream.write(pieces[k])
+			stream.write("\n")
+		return
+
+	line1, line2, filled = [], [], 0
+	for piece1, piece2 in alignedPieces(seq1,seq2,ops):
+		k = 0
+		while k < len(piece1):
+			take = min(width - filled, len(piece1) - k)
+			line1.append(piece1[k:k+take])
+			line2.append(piece2[k:k+take])
+			k, filled = k+take, filled+take
+			if filled == width:
+				stream.write("%s\n%s\n\n" % ("".join(line1), "".join(line2)))
+				line1, line2, filled = [], [], 0
+	if filled:
+		stream.write("%s\n%s\n\n" % ("".join(line1), "".join(line2)))
+
+###############################################################################
+# PACKED TRACEBACK STORE
+# The four pointer codes need two bits each, so one byte holds four cells of
+# a TB row: cell j lives in bits 2*(j%4) .. 2*(j%4)+1 of byte j//4.
+###############################################################################
+
+# bytes per cell of a PackedTB
+PACKED_CELL_BYTES = 0.25
+
+class PackedTB:
+	"""rows x cols traceback table with four 2-bit pointers per byte
+
+	   TB[i] = codes packs a whole row (an array of cols codes, or a single
+	   code for every cell), TB[i, j] = code sets one cell and TB.get(i, j)
+	   reads one back.
+	"""
+	def __init__(self, rows, cols):
+		self.rows = rows
+		self.cols = cols
+		self.data = numpy.zeros((rows, (cols+3) // 4), numpy.uint8)
+		self.scratch = numpy.zeros(4 * self.data.shape[1], numpy.uint8)
+
+	def __setitem__(self, key, codes):
+		if isinstance(key, tuple):
+			i, j = key
+			shift = 2 * (j & 3)
+			byte = int(self.data[i, j >> 2]) & ~(3 << shift)
+			self.data[i, j >> 2] = byte | (codes << shift)
+			return
+		self.scratch[:self.cols] = codes
+		quads = self.scratch.reshape(-1, 4)
+		row = self.data[key]
+		row[:] = quads[:, 0]
+		row |= quads[:, 1] << 2
+		row |= quads[:, 2] << 4
+		row |= quads[:, 3] << 6
+
+	def get(self, i, j):
+		return (int(self.data[i, j >> 2]) >> (2 * (j & 3))) & 3
+
+###############################################################################
+# LINEAR-SPACE (HIRSCHBERG) ALIGNMENT
+# seqalignDP keeps the whole F and TB tables, i.e. O(len(seq1)*len(seq2))
+# memory. The functions below only ever keep two rows of F, and recover the
+# same alignment that traceback() would have produced by divide-and-conquer.
+###############################################################################
+
+# approximate number of bytes one cell of F plus one cell of TB costs in the
+# list-of-lists tables built by seqalignDP (two list slots and a boxed int)
+DP_CELL_BYTES = 40
+
+# subproblems with at most this many cells are solved directly by seqalignDP
+HIRSCHBERG_BASE_CELLS = 4096
+
+def dpTableBytes(seq1,seq2,cell_bytes=DP_CELL_BYTES):
+	"""return the approximate memory used by the DP tables for seq1 and seq2"""
+	return (len(seq1)+1) * (len(seq2)+1) * cell_bytes
+
+def rowProfile(seq1,seq2,subst_matrix):
+	"""return (codes1, profile) as lists for the pure-Python fills: the
+	   base codes of seq1 and profile[c][j], the score of base code c
+	   against seq2[j]"""
+	profile = numpy.array(subst_matrix)[:, encodeSeq(seq2)]
+	return encodeSeq(seq1).tolist(), profile.tolist()
+
+def nwLastRow(seq1,seq2,subst_matrix,gap_pen):
+	"""return the last row of the Needleman-Wunsch table F for seq1 and seq2
+	   as an int64 array, keeping only two rows in memory (the shifted
+	   running-max rows of seqalignScore)
+	"""
+	m = len(seq2)
+	codes1 = encodeSeq(seq1)
+	profile = numpy.array(subst_matrix, numpy.int64)[:, encodeSeq(seq2)] + gap_pen
+	ramp = gap_pen * numpy.arange(m+1, dtype=numpy.int64)
+
+	row = numpy.zeros(m+1, numpy.int64)
+	T = numpy.empty(m+1, numpy.int64)
+	up = T[1:]
+	for i in xrange(1, len(seq1)+1):
+		numpy.subtract(row[1:], gap_pen, up)
+		numpy.maximum(up, row[:-1] + profile[codes1[i-1]], up)
+		T[0] = 0 - i*gap_pen
+		numpy.maximum.accumulate(T, out=row)
+	return row - ramp
+
+def crossRow(seq1,seq2,mid,subst_matrix,gap_pen):
+	"""return (j, score) where j is the column at which the traceback() path
+	   for seq1 and seq2 first reaches row mid, and score is the optimal score
+
+	   Below row mid every cell carries the column where its own traceback
+	   path reaches row mid, using the same tie-breaking as seqalignDP, so
+	   the split point agrees exactly with the full-table traceback.
+	"""
+	m = len(seq2)
+	prev = nwLastRow(seq1[:mid],seq2,subst_matrix,gap_pen)
+	prevcol = numpy.arange(m+1)
+	codes1 = encodeSeq(seq1)
+	profile = numpy.array(subst_matrix, numpy.int64)[:, encodeSeq(seq2)]
+	ramp = gap_pen * numpy.arange(m+1, dtype=numpy.int64)
+	cols = numpy.arange(m+1)
+
+	T, Tcol = numpy.empty(m+1, numpy.int64), numpy.empty(m+1, numpy.int64)
+	for i in xrange(mid+1, len(seq1)+1):
+		# diagonal before up on ties
+		diag = prev[:-1] + profile[codes1[i-1]]
+		up = prev[1:] - gap_pen
+		T[0], Tcol[0] = 0 - i*gap_pen, 0
+		numpy.maximum(diag, up, T[1:])
+		Tcol[1:] = numpy.where(diag >= up, prevcol[:-1], prevcol[1:])
+
+		row = numpy.maximum.accumulate(T + ramp) - ramp
+		# a cell only takes the horizontal gap when it beats T, so its path
+		# leaves the row at the last column k <= j where row[k] == T[k]
+		src = numpy.where(row == T, cols, 0)
+		numpy.maximum.accumulate(src, out=src)
+		prev, prevcol = row, Tcol[src]
+	return int(prevcol[-1]), int(prev[-1])
+
+def hirschberg(seq1,seq2,subst_matrix,gap_pen):
+	"""return (score, s1, s2) for the optimal Needleman-Wunsch alignment of
+	   seq1 and seq2 in O(len(seq1)+len(seq2)) memory
+
+	   s1 and s2 are identical to the strings traceback() returns for the
+	   tables of seqalignDP(seq1,seq2,subst_matrix,gap_pen).
+	"""
+	if len(seq1) <= 1 or (len(seq1)+1) * (len(seq2)+1) <= HIRSCHBERG_BASE_CELLS:
+		score, F, TB = seqalignDP(seq1,seq2,subst_matrix,gap_pen)
+		s1, s2 = traceback(seq1,seq2,TB)
+		return score, s1, s2
+
+	mid = len(seq1) // 2
+	j, score = crossRow(seq1,seq2,mid,subst_matrix,gap_pen)
+
+	# the path through (mid, j) splits into two independent alignments
+	a1, a2 = hirschberg(seq1[:mid],seq2[:j],subst_matrix,gap_pen)[1:]
+	b1, b2 = hirschberg(seq1[mid:],seq2[j:],subst_matrix,gap_pen)[1:]
+	return score, a1 + b1, a2 + b2
+
+
+###############################################################################
+# VECTORIZED (NUMPY) ALIGNMENT
+# Same recurrence and tie-breaking as seqalignDP, but each row of F and TB is
+# computed with a handful of int32 array operations. The rows are filled in
+# the shifted form G[i][j] = F[i][j] + j*gap_pen, where the horizontal gap
+# move costs nothing, so the whole gap chain within a row is a running max:
+#   G[i][j] = max over k <= j of T[k],  T = max(diag, up)
+###############################################################################
+
+# bytes per cell of the int32 F and uint8 TB arrays of seqalignDPNumpy
+NUMPY_CELL_BYTES = 5
+
+def seqalignDPNumpy(seq1,seq2,subst_matrix,gap_pen,packed=False,
+		min_score=None):
+	"""return (score, F, TB) exactly like seqalignDP, with F and TB as numpy
+	   arrays (int32 and uint8) that traceback() can index as TB[i][j]
+
+	   With packed set, TB is a PackedTB and F is None: only two rows of F
+	   are kept, so the memory is a quarter byte per cell.
+
+	   With min_score set, returns ABANDONED as soon as the score is certain
+	   to stay below min_score.
+	"""
+	n, m = len(seq1), len(seq2)
+	codes1 = encodeSeq(seq1)
+	# shifted query profile: row k holds gap_pen + the substitution score of
+	# base k against every base of seq2
+	profile = numpy.array(subst_matrix, numpy.int32)[:, encodeSeq(seq2)]
+	profile += gap_pen
+	ramp = numpy.arange(m+1, dtype=numpy.int32) * gap_pen
+
+	if packed:
+		F = numpy.empty((2, m+1), numpy.int32)
+		TB = PackedTB(n+1, m+1)
+		tbrow = numpy.empty(m+1, numpy.uint8)
+		tbrow[0] = PTR_GAP2
+	else:
+		F = numpy.empty((n+1, m+1), numpy.int32)
+		TB = numpy.empty((n+1, m+1), numpy.uint8)
+		TB[1:, 0] = PTR_GAP2
+	F[0] = 0
+	TB[0] = PTR_GAP1
+	TB[0, 0] = PTR_NONE
+
+	# scratch rows, reused for every i
+	diag = numpy.empty(m, numpy.int32)
+	T = numpy.empty(m+1, numpy.int32)
+	isdiag = numpy.empty(m, numpy.bool_)
+	notleft = numpy.empty(m, numpy.bool_)
+	for i in xrange(1, n+1):
+		prev, row = F[(i-1) % len(F)], F[i % len(F)]
+		tb = tbrow[1:] if packed else TB[i, 1:]
+		up = T[1:]
+		numpy.add(prev[:-1], profile[codes1[i-1]], diag)
+		numpy.subtract(prev[1:], gap_pen, up)
+		numpy.greater_equal(diag, up, isdiag)
+		numpy.maximum(diag, up, up)
+		T[0] = 0 - i*gap_pen
+		numpy.maximum.accumulate(T, out=row)
+
+		# G == T unless the horizontal gap strictly wins; otherwise diag
+		# beats up on ties, which gives the seqalignDP pointer as
+		#   TB = notleft * (1 + isdiag) + 1
+		numpy.equal(row[1:], up, notleft)
+		numpy.add(isdiag, numpy.uint8(1), tb)
+		tb *= notleft
+		tb += 1
+		if packed:
+			TB[i] = tbrow
+
+		if min_score is not None and i % ABANDON_INTERVAL == 0 and \
+				cannotReach(row,n,m,i,subst_matrix,gap_pen,min_score):
+			return ABANDONED
+
+	score = int(F[n % len(F), m]) - m*gap_pen
+	if min_score is not None and score < min_score:
+		return ABANDONED
+	if packed:
+		return score, None, TB
+
+	# undo the shift
+	F -= ramp
+	return score, F, TB
+
+###############################################################################
+# SCORE-ONLY ALIGNMENT
+# When only the score (or the distance in main) is needed there is no point
+# in keeping F or TB: two rows are enough, and the score of aligning a
+# sequence with itself usually has a closed form.
+###############################################################################
+
+def seqalignScore(seq1,seq2,subst_matrix,gap_pen,min_score=None):
+	"""return the optimal Needleman-Wunsch score for seq1 and seq2 using two
+	   rolling rows (same shifted running-max rows as seqalignDPNumpy)
+
+	   With min_score set, returns None as soon as the score is certain to
+	   stay below min_score.
+	"""
+	# walk the shorter sequence so each row is as long as possible
+	S = numpy.array(subst_matrix, numpy.int32)
+	if len(seq1) > len(seq2):
+		seq1, seq2, S = seq2, seq1, S.T
+
+	m = len(seq2)
+	codes1 = encodeSeq(seq1)
+	profile = S[:, encodeSeq(seq2)] + gap_pen
+
+	row = numpy.zeros(m+1, numpy.int32)
+	T = numpy.empty(m+1, numpy.int32)
+	up = T[1:]
+	for i in xrange(1, len(seq1)+1):
+		numpy.subtract(row[1:], gap_pen, up)
+		numpy.maximum(up, row[:-1] + profile[codes1[i-1]], up)
+		T[0] = 0 - i*gap_pen
+		numpy.maximum.accumulate(T, out=row)
+		if min_score is not None and i % ABANDON_INTERVAL == 0 and \
+				cannotReach(row,len(seq1),m,i,S,gap_pen,min_score):
+			return None
+	score = int(row[m]) - m*gap_pen
+	if min_score is not None and score < min_score:
+		return None
+	return score
+
+def diagonalDominant(subst_matrix,gap_pen):
+	"""return True if aligning any sequence with itself base-for-base is
+	   optimal, i.e. S[a][b] <= (S[a][a] + S[b][b]) / 2 for all a, b and
+	   S[a][a] >= -2*gap_pen for all a
+	"""
+	for a in xrange(len(subst_matrix)):
+		if subst_matrix[a][a] < -2*gap_pen:
+			return False
+		for b in xrange(len(subst_matrix)):
+			if 2*subst_matrix[a][b] > subst_matrix[a][a] + subst_matrix[b][b]:
+				return False
+	return True
+
+def selfScore(seq,subst_matrix,gap_pen):
+	"""return the optimal Needleman-Wunsch score of seq against itself
+
+	   Under a diagonal-dominant matrix this is just the sum of the diagonal
+	   entries of seq's bases, otherwise it falls back to seqalignScore.
+	"""
+	if not diagonalDominant(subst_matrix,gap_pen):
+		return seqalignScore(seq,seq,subst_matrix,gap_pen)
+	diag = numpy.array([subst_matrix[k][k] for k in xrange(len(subst_matrix))])
+	counts = numpy.bincount(encodeSeq(seq), minlength=len(diag))
+	return int(numpy.dot(counts, diag))
+
+###############################################################################
+# BANDED ALIGNMENT
+# For near-identical sequences the optimal path stays close to the main
+# diagonal, so only the diagonals j - i in [lo, hi] are filled, with
+# lo = min(0, m-n) - width and hi = max(0, m-n) + width. Row i of the band
+# arrays holds columns i+lo .. i+hi, so both moves from the previous row stay
+# at fixed offsets: diag is the same index k, up is k+1.
+###############################################################################
+
+# first width tried by seqalignBandedAdaptive
+BAND_START = 32
+
+# stands in for -infinity outside the band (far from int32 overflow)
+BAND_NEG = -2**30
+
+class BandedTable:
+	"""read-only (n+1) x (m+1) view of a band-indexed array, so that
+	   traceback() can index it as TB[i][j]; cells outside the band read as
+	   fill
+	"""
+	def __init__(self, data, lo, fill):
+		self.data = data
+		self.lo = lo
+		self.fill = fill
+
+	def __getitem__(self, i):
+		return BandedTable.Row(self.data[i], i + self.lo, self.fill)
+
+	def get(self, i, j):
+		k = j - i - self.lo
+		if 0 <= k < self.data.shape[1]:
+			return self.data.item(i, k)
+		return self.fill
+
+	class Row:
+		def __init__(self, data, offset, fill):
+			self.data = data
+			self.offset = offset
+			self.fill = fill
+
+		def __getitem__(self, j):
+			k = j - self.offset
+			if 0 <= k < len(self.data):
+				return self.data[k]
+			return self.fill
+
+def bandLimits(seq1,seq2,width):
+	"""return the (lo, hi) diagonal range of a band of the given width"""
+	delta = len(seq2) - len(seq1)
+	return min(0, delta) - width, max(0, delta) + width
+
+def seqalignBanded(seq1,seq2,subst_matrix,gap_pen,width):
+	"""return (score, F, TB) for the best Needleman-Wunsch alignment whose
+	   path stays within width diagonals of the band containing both
+	   corners; F and TB are BandedTable views usable by traceback()
+
+	   Only O(len(seq1) * width) cells are stored. The score is a lower
+	   bound on the unbanded one (see bandIsOptimal).
+	"""
+	n, m = len(seq1), len(seq2)
+	lo, hi = bandLimits(seq1,seq2,width)
+	W = hi - lo + 1
+	codes1 = encodeSeq(seq1)
+	profile = numpy.array(subst_matrix, numpy.int32)[:, encodeSeq(seq2)]
+	ramp = numpy.arange(m+1, dtype=numpy.int32) * gap_pen
+
+	# the extra column stays at BAND_NEG so that up = k+1 never runs off
+	# the band
+	F = numpy.empty((n+1, W+1), numpy.int32)
+	F.fill(BAND_NEG)
+	TB = numpy.zeros((n+1, W), numpy.uint8)
+	F[0, -lo:min(m, hi)-lo+1] = -ramp[:min(m, hi)+1]
+	TB[0, -lo+1:min(m, hi)-lo+1] = PTR_GAP1
+
+	for i in xrange(1, n+1):
+		jlo, jhi = max(0, i+lo), min(m, i+hi)
+		k0, k1 = jlo-i-lo, jhi-i-lo+1
+		prev, row, tb = F[i-1], F[i], TB[i]
+
+		# the running max of seqalignDPNumpy, restricted to the band; the
+		# first column has no left neighbour and is a plain vertical gap
+		T = numpy.empty(k1-k0, numpy.int32)
+		first = 0
+		if jlo == 0:
+			T[0] = 0 - i*gap_pen
+			tb[k0] = PTR_GAP2
+			first = 1
+		diag = prev[k0+first:k1] + profile[codes1[i-1], jlo+first-1:jhi]
+		up = prev[k0+first+1:k1+1] - gap_pen
+		numpy.maximum(diag, up, T[first:])
+		T += ramp[jlo:jhi+1]
+		numpy.maximum.accumulate(T, out=row[k0:k1])
+		T -= ramp[jlo:jhi+1]
+		row[k0:k1] -= ramp[jlo:jhi+1]
+
+		# same pointer expression as seqalignDPNumpy
+		cell = tb[k0+first:k1]
+		numpy.add(diag >= up, numpy.uint8(1), cell)
+		cell *= (row[k0+first:k1] == T[first:])
+		cell += 1
+
+	F = F[:, :W]
+	return int(F[n, m-n-lo]), BandedTable(F, lo, BAND_NEG), \
+		BandedTable(TB, lo, PTR_NONE)
+
+def bandIsOptimal(seq1,seq2,subst_matrix,gap_pen,width,score):
+	"""return True if no alignment leaving the band of the given width can
+	   score as high as score, so that score is the unbanded optimum
+
+	   A path reaching a diagonal outside the band uses at least
+	   G = |m-n| + 2*(width+1) gaps, hence at most (n+m-G)/2 aligned pairs,
+	   and scores at most max(S) * (n+m-G)/2 - gap_pen * G.
+	"""
+	n, m = len(seq1), len(seq2)
+	gaps = abs(m - n) + 2*(width + 1)
+	if gaps > n + m:
+		return True
+	smax = max(max(row) for row in subst_matrix)
+	return 2*score > smax * (n + m - gaps) - 2*gap_pen*gaps
+
+def bandMaxWidth(seq1,seq2,budget):
+	"""return the largest band width whose tables fit in budget bytes"""
+	per_diag = (len(seq1)+1) * NUMPY_CELL_BYTES
+	return max(0, (int(budget) // per_diag - abs(len(seq2) - len(seq1)) - 1) // 2)
+
+def seqalignBandedAdaptive(seq1,seq2,subst_matrix,gap_pen,width=BAND_START,
+		max_width=None):
+	"""return (score, F, TB, width) from seqalignBanded, doubling the width
+	   until bandIsOptimal proves the banded score is the unbanded optimum or
+	   the width reaches max_width
+	"""
+	while True:
+		score, F, TB = seqalignBanded(seq1,seq2,subst_matrix,gap_pen,width)
+		if bandIsOptimal(seq1,seq2,subst_matrix,gap_pen,width,score) or \
+		   (max_width is not None and width >= max_width):
+			return score, F, TB, width
+		width = max(1, 2*width)
+		if max_width is not None:
+			width = min(width, max_width)
+
+###############################################################################
+# SEED-AND-EXTEND LOCAL ALIGNMENT
+# BLAST-style pipeline on top of the dotplot k-mer hits (kmers.py):
+#  1. hits on the same diagonal that overlap are merged into ungapped anchors
+#  2. anchors are chained into co-linear chains
+#  3. the DP is only run in the gaps between consecutive anchors of a chain,
+#     and outwards from both ends of the chain with X-drop pruning
+###############################################################################
+
+# defaults for the local mode of main()
+SEED_KMERLEN = 20
+SEED_XDROP = 30
+SEED_MAX_EXTEND = 500
+CHAIN_MAX_GAP = 2000
+CHAIN_LOOKBACK = 50
+
+def diagonalAnchors(hits,kmerlen):
+	"""merge forward k-mer hits (the arrays index_in_seq2, index_in_seq1 of
+	   findHits) that touch or overlap on the same diagonal into ungapped
+	   anchors (i, j, length), sorted by position in seq1
+	"""
+	j, i = hits[0], hits[1]
+	if not len(i):
+		return []
+	order = numpy.lexsort((i, j - i))
+	i, j = i[order], j[order]
+	# an anchor starts at each new diagonal, or where a gap follows the
+	# previous hit on the same one
+	start = numpy.ones(len(i), numpy.bool_)
+	start[1:] = ((j - i)[1:] != (j - i)[:-1]) | (i[1:] > i[:-1] + kmerlen)
+	first = numpy.flatnonzero(start)
+	last = numpy.append(first[1:], len(i)) - 1
+	return sorted(zip(i[first].tolist(), j[first].tolist(),
+		(i[last] + kmerlen - i[first]).tolist()))
+
+def ungappedScore(codes1,codes2,i,j,length,subst_matrix):
+	"""return the score of the ungapped alignment of length bases at i, j"""
+	return int(subst_matrix[codes1[i:i+length], codes2[j:j+length]].sum())
+
+def chainAnchors(anchors,scores,gap_pen,max_gap=CHAIN_MAX_GAP,
+		lookback=CHAIN_LOOKBACK):
+	"""return co-linear chains of anchors as (score, [anchor, ...]) sorted by
+	   decreasing score
+
+	   Each anchor may follow one of the lookback anchors before it that ends
+	   before it in both sequences, at most max_gap bases away, paying
+	   gap_pen per base of the difference between the two gap lengths.
+	"""
+	best = list(scores)
+	pred = [-1] * len(anchors)
+	for k in xrange(len(anchors)):
+		i, j, length = anchors[k]
+		for p in xrange(k-1, max(-1, k-1-lookback), -1):
+			pi, pj, plen = anchors[p]
+			di, dj = i - (pi + plen), j - (pj + plen)
+			if di > max_gap:
+				break
+			if di < 0 or dj < 0 or dj > max_gap:
+				continue
+			score = best[p] + scores[k] - gap_pen * abs(di - dj)
+			if score > best[k]:
+				best[k], pred[k] = score, p
+
+	# peel off chains from the best end down, each anchor used once
+	chains = []
+	used = [False] * len(anchors)
+	for k in sorted(xrange(len(anchors)), key=lambda k: -best[k]):
+		if used[k]:
+			continue
+		chain = []
+		p = k
+		while p != -1 and not used[p]:
+			used[p] = True
+			chain.append(anchors[p])
+			p = pred[p]
+		chain.reverse()
+		chains.append((best[k] - (best[p] if p != -1 else 0), chain))
+	chains.sort(key=lambda chain: -chain[0])
+	return chains
+
+def xdropExtend(seq1,seq2,subst_matrix,gap_pen,xdrop):
+	"""return (score, len1, len2, s1, s2) for the best alignment of a prefix
+	   of seq1 with a prefix of seq2, exploring only the cells that score
+	   within xdrop of the best score of the rows before (BLAST X-drop)
+	"""
+	codes1, profile = rowProfile(seq1,seq2,subst_matrix)
+	best, besti, bestj = 0, 0, 0
+	hi = min(len(seq2), xdrop // gap_pen)
+	rows = [(0, [0 - j*gap_pen for j in xrange(hi+1)])]
+	tbs = [[PTR_NONE] + [PTR_GAP1] * hi]
+
+	for i in xrange(1, len(seq1)+1):
+		plo, prev = rows[-1]
+		phi = plo + len(prev) - 1
+		sub = profile[codes1[i-1]]
+		cutoff = best - xdrop
+		row, tb = [], []
+		for j in xrange(plo, len(seq2)+1):
+			diag = up = left = BAND_NEG
+			if plo <= j-1 <= phi:
+				diag = prev[j-1-plo] + sub[j-1]
+			if j <= phi:
+				up = prev[j-plo] - gap_pen
+			if row:
+				left = row[-1] - gap_pen
+			if diag >= up and diag >= left:
+				score, ptr = diag, PTR_BASE
+			elif up >= left:
+				score, ptr = up, PTR_GAP2
+			else:
+				score, ptr = left, PTR_GAP1
+			if score < cutoff:
+				# past the previous row only a horizontal gap can reach
+				# further, and it would score even lower
+				if j > phi:
+					break
+				score = BAND_NEG
+			row.append(score)
+			tb.append(ptr)
+
+		# drop the dead cells at both ends of the row
+		live = [k for k in xrange(len(row)) if row[k] != BAND_NEG]
+		if not live:
+			break
+		lo = plo + live[0]
+		row, tb = row[live[0]:live[-1]+1], tb[live[0]:live[-1]+1]
+		rows.append((lo, row))
+		tbs.append(tb)
+		top = max(row)
+		if top > best:
+			best, besti, bestj = top, i, lo + row.index(top)
+
+	s1, s2 = [], []
+	i, j = besti, bestj
+	while tbs[i][j - rows[i][0]] != PTR_NONE:
+		ptr = tbs[i][j - rows[i][0]]
+		if ptr == PTR_BASE:
+			s1.append(seq1[i-1])
+			s2.append(seq2[j-1])
+			i, j = i-1, j-1
+		elif ptr == PTR_GAP1:
+			s1.append('-')
+			s2.append(seq2[j-1])
+			j = j-1
+		else:
+			s1.append(seq1[i-1])
+			s2.append('-')
+			i = i-1
+	s1.reverse()
+	s2.reverse()
+	return best, besti, bestj, "".join(s1), "".join(s2)
+
+def alignChain(seq1,seq2,codes1,codes2,chain,subst_matrix,gap_pen,xdrop,
+		max_extend=SEED_MAX_EXTEND):
+	"""return a local alignment (score, start1, end1, start2, end2, s1, s2)
+	   through the anchors of chain: ungapped over the anchors, global DP in
+	   between and X-drop extension of at most max_extend bases beyond both
+	   ends
+
+	   The cap matters with scores like S/gap_pen above, under which even
+	   unrelated sequences have a positive expected alignment score, so an
+	   X-drop extension alone would only stop at the sequence ends.
+	"""
+	S = numpy.array(subst_matrix, numpy.int32)
+	i0, j0 = chain[0][0], chain[0][1]
+	score, len1, len2, l1, l2 = xdropExtend(
+		seq1[max(0, i0-max_extend):i0][::-1],
+		seq2[max(0, j0-max_extend):j0][::-1], subst_matrix, gap_pen, xdrop)
+	start1, start2 = i0 - len1, j0 - len2
+	parts1, parts2 = [l1[::-1]], [l2[::-1]]
+
+	end1, end2 = i0, j0
+	for i, j, length in chain:
+		if (i, j) != (end1, end2):
+			gap1, gap2 = seq1[end1:i], seq2[end2:j]
+			gapscore, F, TB = seqalignDPNumpy(gap1, gap2, subst_matrix, gap_pen)
+			g1, g2 = traceback(gap1, gap2, TB)
+			score += gapscore
+			parts1.append(g1)
+			parts2.append(g2)
+		score += ungappedScore(codes1, codes2, i, j, length, S)
+		parts1.append(seq1[i:i+length])
+		parts2.append(seq2[j:j+length])
+		end1, end2 = i + length, j + length
+
+	rscore, len1, len2, r1, r2 = xdropExtend(
+		seq1[end1:end1+max_extend], seq2[end2:end2+max_extend],
+		subst_matrix, gap_pen, xdrop)
+	parts1.append(r1)
+	parts2.append(r2)
+	return (score + rscore, start1, end1 + len1, start2, end2 + len2,
+			"".join(parts1), "".join(parts2))
+
+def covers(alignment,chain):
+	"""return True if all anchors of chain lie inside the rectangle spanned
+	   by alignment"""
+	start1, end1, start2, end2 = alignment[1:5]
+	for i, j, length in chain:
+		if i < start1 or i + length > end1 or j < start2 or j + length > end2:
+			return False
+	return True
+
+def seedExtend(seq1,seq2,hits,kmerlen,subst_matrix,gap_pen,
+		xdrop=SEED_XDROP,min_score=0,max_extend=SEED_MAX_EXTEND):
+	"""return the local alignments (score, start1, end1, start2, end2, s1, s2)
+	   seeded by forward-strand k-mer hits (index_in_seq2, index_in_seq1),
+	   best first; coordinates are 0-based, ends exclusive
 
-	return s1,s2
+	   Chains whose anchors all fall inside an alignment already reported
+	   are skipped.
+	"""
+	codes1, codes2 = encodeSeq(seq1), encodeSeq(seq2)
+	S = numpy.array(subst_matrix, numpy.int32)
+	anchors = diagonalAnchors(hits, kmerlen)
+	scores = [ungappedScore(codes1, codes2, i, j, length, S)
+		for i, j, length in anchors]
+
+	alignments = []
+	for chainscore, chain in chainAnchors(anchors, scores, gap_pen):
+		if any(covers(a, chain) for a in alignments):
+			continue
+		alignment = alignChain(seq1, seq2, codes1, codes2, chain,
+			subst_matrix, gap_pen, xdrop, max_extend)
+		if alignment[0] >= min_score:
+			alignments.append(alignment)
+	alignments.sort(key=lambda a: -a[0])
+	return alignments
+
+###############################################################################
+# ANCHORED GLOBAL ALIGNMENT
+# A global alignment forced through the best co-linear chain of exact k-mer
+# anchors (merged as in the local mode above, but chained over the whole
+# sequences without gap costs). Only the gaps between consecutive
+# anchors, and before the first and after the last one, go through the DP;
+# gaps that are still too large are anchored again with shorter k-mers.
+# The result is not guaranteed to be the optimal Needleman-Wunsch alignment.
+###############################################################################
+
+ANCHOR_MIN_KMERLEN = 8
+
+# gaps with at most this many DP cells are aligned directly
+ANCHOR_MAX_CELLS = 4 * 10**6
+
+def colinearChain(anchors,scores):
+	"""return the co-linear chain of anchors (i, j, length) with the largest
+	   total score, with no gap costs, in O(A log A)
+
+	   Anchors are swept by position in seq1; a Fenwick tree over anchor end
+	   positions in seq2 gives the best chain ending before each new anchor.
+	"""
+	ends = sorted(set(j + length for i, j, length in anchors))
+	rank = dict((end, r+1) for r, end in enumerate(ends))
+	tree = [(0, -1)] * (len(ends) + 1)
+	best = [0] * len(anchors)
+	pred = [-1] * len(anchors)
+
+	# at equal positions ends come before starts, anchors may touch
+	events = [(i + length, 0, k) for k, (i, j, length) in enumerate(anchors)]
+	events += [(i, 1, k) for k, (i, j, length) in enumerate(anchors)]
+	events.sort()
+	for pos, start, k in events:
+		i, j, length = anchors[k]
+		if start:
+			# best chain whose last anchor ends at or before j in seq2
+			r = bisect.bisect_right(ends, j)
+			top = (0, -1)
+			while r > 0:
+				top = max(top, tree[r])
+				r -= r & -r
+			best[k], pred[k] = top[0] + scores[k], top[1]
+		else:
+			r = rank[j + length]
+			while r <= len(ends):
+				tree[r] = max(tree[r], (best[k], k))
+				r += r & -r
+
+	chain = []
+	k = max(xrange(len(anchors)), key=lambda k: best[k])
+	while k != -1:
+		chain.append(anchors[k])
+		k = pred[k]
+	chain.reverse()
+	return chain
+
+def gapAlign(seq1,seq2,subst_matrix,gap_pen,mem_budget):
+	"""return (score, s1, s2) for the optimal alignment of seq1 and seq2,
+	   from the numpy tables if they fit in mem_budget bytes, else in
+	   linear memory
+	"""
+	if dpTableBytes(seq1,seq2,NUMPY_CELL_BYTES) <= mem_budget:
+		score, F, TB = seqalignDPNumpy(seq1,seq2,subst_matrix,gap_pen)
+		s1, s2 = traceback(seq1,seq2,TB)
+		return score, s1, s2
+	return hirschberg(seq1,seq2,subst_matrix,gap_pen)
+
+def anchoredAlign(seq1,seq2,subst_matrix,gap_pen,kmerlen=SEED_KMERLEN,
+		mem_budget=2**30,max_cells=ANCHOR_MAX_CELLS):
+	"""return (score, s1, s2) for a global alignment of seq1 and seq2 through
+	   the best chain of forward k-mer anchors, with the DP only between
+	   anchors; gaps larger than max_cells are anchored again with k-mers
+	   of half the length, down to ANCHOR_MIN_KMERLEN
+	"""
+	n, m = len(seq1), len(seq2)
+	if (n+1) * (m+1) <= max_cells or kmerlen < ANCHOR_MIN_KMERLEN:
+		return gapAlign(seq1,seq2,subst_matrix,gap_pen,mem_budget)
+
+	hits = findHits(buildIndex(seq1, kmerlen), seq2, kmerlen, inversions=False)
+	if not len(hits[0]):
+		return anchoredAlign(seq1,seq2,subst_matrix,gap_pen,kmerlen // 2,
+			mem_budget,max_cells)
+	codes1, codes2 = encodeSeq(seq1), encodeSeq(seq2)
+	S = numpy.array(subst_matrix, numpy.int32)
+	anchors = diagonalAnchors(hits, kmerlen)
+	scores = [ungappedScore(codes1, codes2, i, j, length, S)
+		for i, j, length in anchors]
+	chain = colinearChain(anchors, scores)
 
-def readSeq(filename):
-    """reads in a FASTA sequence"""
+	score = 0
+	parts1, parts2 = [], []
+	end1, end2 = 0, 0
+	for i, j, length in chain + [(n, m, 0)]:
+		gapscore, g1, g2 = anchoredAlign(seq1[end1:i], seq2[end2:j],
+			subst_matrix, gap_pen, kmerlen // 2, mem_budget, max_cells)
+		score += gapscore + ungappedScore(codes1, codes2, i, j, length, S)
+		parts1.extend((g1, seq1[i:i+length]))
+		parts2.extend((g2, seq2[j:j+length]))
+		end1, end2 = i + length, j + length
+	return score, "".join(parts1), "".join(parts2)
+
+###############################################################################
+# BATCHED SMITH-WATERMAN
+# Smith-Waterman on the rolling rows of seqalignScore, clamped at 0 by taking
+# the max with the shifted zero row (j*gap_pen) before the running max. The
+# rows run along the database sequences, and up to `lanes` of them are
+# stacked as the rows of one 2D array (padded to the longest with a code that
+# scores below every real base), so each query base is one pass over all of
+# them, using the query profile prof[c] of base c against every database
+# cell. Each int64 cell also carries the cell its alignment started from in
+# its low `shift` bits: every move adds a multiple of 2**shift, so the maxes
+# keep a start of an optimal path and no second fill is needed for the
+# coordinates.
+###############################################################################
+
+# database sequences filled together in one batch
+SW_LANES = 64
+
+def swProfile(codes2,subst_matrix,gap_pen,shift):
+	"""return the query profile of the database code arrays codes2:
+	   prof[c][k, j] is (S[c][codes2[k][j]] + 2*gap_pen) << shift, with the
+	   padding past the end of each array scoring below every real base"""
+	S = numpy.array(subst_matrix, numpy.int64)
+	Sx = numpy.empty((len(S), len(S)+1), numpy.int64)
+	Sx.fill(min(int(S.min()), 0) - 1)
+	Sx[:, :-1] = S
+	cells = numpy.empty((len(codes2), max(max(len(c) for c in codes2), 1)),
+		numpy.uint8)
+	cells.fill(len(S))
+	for k, codes in enumerate(codes2):
+		cells[k, :len(codes)] = codes
+	return (Sx[:, cells] + 2*gap_pen) << shift
+
+def swBatch(codes1,codes2,subst_matrix,gap_pen):
+	"""return (score, start1, end1, start2, end2) arrays for the best local
+	   alignment of the query codes1 with each database code array in codes2,
+	   ending in the first query row that reaches the score
+	"""
+	n, lanes = len(codes1), len(codes2)
+	width = max(max(len(c) for c in codes2), 1)
+	# start codes i * (width+1) + j below 2**shift, scores above
+	shift = ((n+1) * (width+1)).bit_length()
+	smax = max(0, max(max(row) for row in subst_matrix))
+	if (smax * min(n, width) + gap_pen * (n+width+3)) >> (62 - shift):
+		raise ValueError("sequences too long for a 64-bit fill")
+	prof = swProfile(codes2,subst_matrix,gap_pen,shift)
+
+	# row i holds (H[i][j] + (i+j)*gap_pen) << shift plus the start code, so
+	# that a vertical gap keeps the value of the cell above
+	step = gap_pen << shift
+	ramp = (gap_pen * numpy.arange(width+1, dtype=numpy.int64)) << shift
+	zero = ramp + numpy.arange(width+1)
+	row = numpy.tile(zero, (lanes, 1))
+	T = numpy.empty_like(row)
+	clamp, H = numpy.empty_like(zero), numpy.empty_like(row)
+
+	score = numpy.zeros(lanes, numpy.int64)
+	start = numpy.zeros(lanes, numpy.int64)
+	end1 = numpy.zeros(lanes, numpy.int64)
+	end2 = numpy.zeros(lanes, numpy.int64)
+	for i in xrange(1, n+1):
+		numpy.add(row[:, :-1], prof[codes1[i-1]], T[:, 1:])
+		numpy.maximum(T[:, 1:], row[:, 1:], T[:, 1:])
+		# a new alignment may start at any cell of row i
+		numpy.add(zero, i * step + i * (width+1), clamp)
+		numpy.maximum(T[:, 1:], clamp[1:], T[:, 1:])
+		T[:, 0] = clamp[0]
+		numpy.maximum.accumulate(T, axis=1, out=row)
+
+		numpy.subtract(row, ramp, H)
+		rowmax = H.max(axis=1) - i * step
+		better = (rowmax >> shift) > score
+		if better.any():
+			k = numpy.flatnonzero(better)
+			score[k] = rowmax[k] >> shift
+			start[k] = rowmax[k] & ((1 << shift) - 1)
+			end1[k] = i
+			end2[k] = H[k].argmax(axis=1)
+	start1, start2 = numpy.divmod(start, width+1)
+	return score, start1, end1, start2, end2
+
+def swScores(seq1,seqs,subst_matrix,gap_pen,lanes=SW_LANES):
+	"""return a list of (score, start1, end1, start2, end2), the best local
+	   alignment of seq1 with each sequence in seqs, aligning
+	   seq1[start1:end1] with seq[start2:end2] (all zeros when no pair of
+	   bases scores above 0)
+
+	   Sequences of similar length are filled together, lanes at a time.
+	"""
+	codes1 = encodeSeq(seq1)
+	codes2 = [encodeSeq(seq) for seq in seqs]
+	order = sorted(xrange(len(seqs)), key=lambda k: len(seqs[k]))
+	results = [None] * len(seqs)
+	for first in xrange(0, len(order), lanes):
+		batch = order[first:first+lanes]
+		columns = swBatch(codes1,[codes2[k] for k in batch],subst_matrix,gap_pen)
+		for k, result in zip(batch, zip(*columns)):
+			results[k] = tuple(int(x) for x in result)
+	return results
+
+###############################################################################
+# BIT-PARALLEL EDIT DISTANCE (MYERS / HYYRO)
+# Unit-cost (Levenshtein) distance with one DP column per text base. The
+# column is kept as its vertical +1/-1 deltas in two bit vectors Pv and Mv,
+# one bit per pattern base, and each column update is a fixed handful of
+# and/or/xor/add/shift operations on them. The vectors are Python longs, so
+# the word operations run 30-64 cells at a time inside the interpreter's
+# bignum code, for patterns of any length.
+###############################################################################
+
+def editDistance(seq1,seq2,threshold=None):
+	"""return the edit distance between seq1 and seq2, or None as soon as it
+	   is certain to exceed threshold
+	"""
+	# the pattern (bit vector) is the shorter sequence
+	if len(seq1) < len(seq2):
+		seq1, seq2 = seq2, seq1
+	pattern, text = seq2, seq1
+	m, n = len(pattern), len(text)
+	if threshold is not None and n - m > threshold:
+		return None
+	if m == 0:
+		return n
 
-    stream = open(filename)
-    seq = []
+	peq = {}
+	for k, base in enumerate(pattern):
+		peq[base] = peq.get(base, 0) | (1 << k)
+	mask = (1 << m) - 1
+	last = 1 << (m-1)
 
-    for line in stream:
-        if line.startswith(">"):
-            continue
-        seq.append(line.rstrip())
+	Pv, Mv, score = mask, 0, m
+	for j, base in enumerate(text):
+		Eq = peq.get(base, 0)
+		Xv = Eq | Mv
+		Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+		Ph = Mv | (~(Xh | Pv) & mask)
+		Mh = Pv & Xh
+		if Ph & last:
+			score += 1
+		elif Mh & last:
+			score -= 1
+		# the top row of a global alignment increases by one per column
+		Ph = ((Ph << 1) | 1) & mask
+		Mh = (Mh << 1) & mask
+		Pv = Mh | (~(Xv | Ph) & mask)
+		Mv = Ph & Xv
+		# the last cell drops by at most one per remaining column
+		if threshold is not None and score - (n - j - 1) > threshold:
+			return None
+	return score
+
+###############################################################################
+# EARLY-ABANDON THRESHOLD ALIGNMENT
+# When only alignments scoring at least min_score matter, seqalignDPNumpy
+# and seqalignScore can stop as soon as no path through the current row can
+# reach it. From cell (i, j) the rest of a path covers a = n-i bases of seq1
+# and b = m-j bases of seq2, so it adds at most
+#   min(a, b) * max(smax, -2*gap_pen) - |a - b| * gap_pen
+# and every path to (n, m) leaves row i through one of its cells.
+###############################################################################
+
+# rows filled between two checks of the bound
+ABANDON_INTERVAL = 8
+
+# returned by seqalignDPNumpy instead of (score, F, TB) when it gives up
+ABANDONED = (None, None, None)
+
+def remainingBound(n,m,i,subst_matrix,gap_pen):
+	"""return an array holding, for every j, an upper bound on the score of
+	   aligning the last n-i bases of seq1 with the last m-j bases of seq2
+	"""
+	smax = max(max(row) for row in subst_matrix)
+	a = n - i
+	b = numpy.arange(m, -1, -1)
+	return numpy.minimum(a, b) * max(smax, -2*gap_pen) \
+		- numpy.abs(a - b) * gap_pen
+
+def cannotReach(G,n,m,i,subst_matrix,gap_pen,min_score):
+	"""return True if no alignment through row i, whose shifted scores
+	   G[j] = F[i][j] + j*gap_pen are given, can score min_score or more
+	"""
+	F = G - gap_pen * numpy.arange(m+1)
+	return (F + remainingBound(n,m,i,subst_matrix,gap_pen)).max() < min_score
+
+###############################################################################
+# ALL-VS-ALL BATCH
+# Distance matrix over every pair of records in a multi-record FASTA, using
+# the same max(sxx, syy) - score_xy distance as main(). Pair scores are
+# computed with seqalignScore in a process pool; the pairs are handed out
+# in chunks, longest first, so neither per-task overhead nor one late long
+# pair dominates. With max_edit set, pairs are first screened with the cheap
+# editDistance and only those within it are scored; with max_distance set,
+# the scoring itself is abandoned once the distance must exceed it. Scores
+# already in an AlignmentCache are not recomputed.
+###############################################################################
+
+# pairs per pool task
+BATCH_CHUNKSIZE = 16
+
+# distance matrix entry of a pair that was screened out, written as NA
+BATCH_NA = -1
+
+# (seqs, self_scores, subst_matrix, gap_pen, max_edit, max_distance, cache)
+# of the current batch, set in each worker
+_batch = None
+
+def _batchInit(seqs,self_scores,subst_matrix,gap_pen,max_edit,max_distance,
+		cache):
+	global _batch
+	_batch = (seqs, self_scores, subst_matrix, gap_pen, max_edit, max_distance,
+		cache)
+
+def _batchDistance(pair):
+	seqs, self_scores, subst_matrix, gap_pen, max_edit, max_distance, cache = \
+		_batch
+	i, j = pair
+	if max_edit is not None and \
+			editDistance(seqs[i],seqs[j],max_edit) is None:
+		return i, j, None
+
+	if cache is not None:
+		key = cacheKey(seqs[i],seqs[j],subst_matrix,gap_pen,"global")
+		cached = cache.get(key)
+		if cached is not None:
+			distance = cached[1]
+			if max_distance is not None and distance > max_distance:
+				return i, j, None
+			return i, j, distance
+
+	sxy = max(self_scores[i], self_scores[j])
+	min_score = None if max_distance is None else sxy - max_distance
+	score = seqalignScore(seqs[i],seqs[j],subst_matrix,gap_pen,min_score)
+	if score is None:
+		return i, j, None
+	if cache is not None:
+		cache.put(key,score,sxy - score)
+	return i, j, sxy - score
+
+def pairDistances(seqs,subst_matrix,gap_pen,procs=None,
+		chunksize=BATCH_CHUNKSIZE,max_edit=None,max_distance=None,cache=None):
+	"""return the symmetric len(seqs) x len(seqs) matrix of distances
+	   max(sxx, syy) - score_xy, computed on procs processes (all cores by
+	   default, in this process if procs == 1)
+
+	   Pairs whose edit distance exceeds max_edit, or whose distance exceeds
+	   max_distance, get BATCH_NA. cache is an optional AlignmentCache shared
+	   by the workers.
+	"""
+	n = len(seqs)
+	self_scores = [selfScore(seq,subst_matrix,gap_pen) for seq in seqs]
+	pairs = [(i, j) for i in xrange(n) for j in xrange(i+1, n)]
+	pairs.sort(key=lambda (i, j): len(seqs[i]) * len(seqs[j]), reverse=True)
+
+	initargs = (seqs, self_scores, subst_matrix, gap_pen, max_edit,
+		max_distance, cache)
+	if procs == 1:
+		_batchInit(*initargs)
+		results = itertools.imap(_batchDistance, pairs)
+		pool = None
+	else:
+		pool = multiprocessing.Pool(procs, _batchInit, initargs)
+		results = pool.imap_unordered(_batchDistance, pairs, chunksize)
+
+	D = numpy.zeros((n, n), numpy.int64)
+	try:
+		for i, j, distance in results:
+			D[i, j] = D[j, i] = BATCH_NA if distance is None else distance
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+	return D
+
+def writeDistanceMatrix(names,D,stream=sys.stdout):
+	"""write D as a square PHYLIP-style matrix: the number of records, then
+	   one line per record with its name and its tab-separated distances
+	   (NA for BATCH_NA)
+	"""
+	print >> stream, len(names)
+	for name, row in itertools.izip(names, D):
+		print >> stream, "\t".join([name] +
+			["NA" if d == BATCH_NA else str(d) for d in row])
+
+###############################################################################
+# WAVEFRONT-TILED PARALLEL ALIGNMENT
+# The F matrix is split into block x block tiles. Tile (bi, bj) only needs
+# the F row above it and the F column to its left, so all tiles on one
+# anti-diagonal bi + bj = d can be filled at the same time by a process
+# pool. The pool shares two arrays with the parent: every block-th row of F
+# and every block-th column of F. Each tile reads its top row and left
+# column from them and writes back its bottom row and right column.
+#
+# Those rows and columns are the checkpoints for the traceback: CheckpointTB
+# refills, with pointers, only the tiles the optimal path passes through.
+###############################################################################
+
+# tile side of wavefrontAlign
+WAVEFRONT_BLOCK = 2048
+
+# shared state of the current wavefront fill, set in each worker
+_wavefront = None
+
+def blockFill(codes1,codes2,top,left,subst_matrix,gap_pen,tb=False):
+	"""fill one tile of F with seqalignDPNumpy's row recurrence
+
+	   top is the F row above the tile and left the F column to its left,
+	   both including the corner; codes1 and codes2 are the bases along the
+	   tile's rows and columns. Returns (bottom, right, TB): the tile's last
+	   F row and last F column, again including the corner, and if tb is
+	   set the tile's pointers (row and column 0 unused), else None.
+	"""
+	h, w = len(codes1), len(codes2)
+	profile = numpy.array(subst_matrix, numpy.int32)[:, codes2] + gap_pen
+	ramp = numpy.arange(w+1, dtype=numpy.int32) * gap_pen
 
-    return "".join(seq)
+	prev = numpy.asarray(top, numpy.int32) + ramp
+	row = numpy.empty(w+1, numpy.int32)
+	right = numpy.empty(h+1, numpy.int32)
+	right[0] = top[w]
+	TB = numpy.empty((h+1, w+1), numpy.uint8) if tb else None
+
+	diag = numpy.empty(w, numpy.int32)
+	T = numpy.empty(w+1, numpy.int32)
+	up = T[1:]
+	isdiag = numpy.empty(w, numpy.bool_)
+	notleft = numpy.empty(w, numpy.bool_)
+	for r in xrange(1, h+1):
+		numpy.add(prev[:-1], profile[codes1[r-1]], diag)
+		numpy.subtract(prev[1:], gap_pen, up)
+		if tb:
+			numpy.greater_equal(diag, up, isdiag)
+		numpy.maximum(diag, up, up)
+		T[0] = left[r]
+		numpy.maximum.accumulate(T, out=row)
+		if tb:
+			numpy.equal(row[1:], up, notleft)
+			numpy.add(isdiag, numpy.uint8(1), TB[r, 1:])
+			TB[r, 1:] *= notleft
+			TB[r, 1:] += 1
+		right[r] = row[w] - w*gap_pen
+		prev, row = row, prev
+	return prev - ramp, right, TB
+
+def _wavefrontInit(codes1,codes2,rows,cols,block,subst_matrix,gap_pen):
+	global _wavefront
+	n, m = len(codes1), len(codes2)
+	_wavefront = (codes1, codes2,
+		numpy.frombuffer(rows, numpy.int32).reshape(-1, m+1),
+		numpy.frombuffer(cols, numpy.int32).reshape(-1, n+1),
+		block, subst_matrix, gap_pen)
+
+def _wavefrontTile(tile):
+	codes1, codes2, rows, cols, block, subst_matrix, gap_pen = _wavefront
+	bi, bj = tile
+	i0, i1 = bi*block, min((bi+1)*block, len(codes1))
+	j0, j1 = bj*block, min((bj+1)*block, len(codes2))
+	bottom, right, TB = blockFill(codes1[i0:i1], codes2[j0:j1],
+		rows[bi, j0:j1+1], cols[bj, i0:i1+1], subst_matrix, gap_pen)
+	# the corners belong to the neighbouring tiles (or the outer border)
+	rows[bi+1, j0+1:j1+1] = bottom[1:]
+	cols[bj+1, i0+1:i1+1] = right[1:]
+
+class CheckpointTB:
+	"""(n+1) x (m+1) pointer table of a wavefront fill that traceback() can
+	   read through get(i, j); the tile holding a cell is refilled from the
+	   checkpoint rows and columns when it is first read, and only the most
+	   recent tile is kept
+	"""
+	def __init__(self, codes1, codes2, rows, cols, block, subst_matrix,
+			gap_pen):
+		self.codes1 = codes1
+		self.codes2 = codes2
+		self.rows = rows
+		self.cols = cols
+		self.block = block
+		self.subst_matrix = subst_matrix
+		self.gap_pen = gap_pen
+		self.tile = None
+		self.TB = None
+
+	def get(self, i, j):
+		if i == 0:
+			return PTR_GAP1 if j else PTR_NONE
+		if j == 0:
+			return PTR_GAP2
+		block = self.block
+		bi, bj = (i-1) // block, (j-1) // block
+		i0, j0 = bi*block, bj*block
+		if self.tile != (bi, bj):
+			i1 = min(i0 + block, len(self.codes1))
+			j1 = min(j0 + block, len(self.codes2))
+			self.TB = blockFill(self.codes1[i0:i1], self.codes2[j0:j1],
+				self.rows[bi, j0:j1+1], self.cols[bj, i0:i1+1],
+				self.subst_matrix, self.gap_pen, tb=True)[2]
+			self.tile = (bi, bj)
+		return self.TB.item(i - i0, j - j0)
+
+def wavefrontAlign(seq1,seq2,subst_matrix,gap_pen,block=WAVEFRONT_BLOCK,
+		procs=None):
+	"""return (score, None, TB) like seqalignDPNumpy(packed=True), with the
+	   tiles of each anti-diagonal filled on procs processes (all cores by
+	   default, in this process if procs == 1) and TB a CheckpointTB
+	"""
+	n, m = len(seq1), len(seq2)
+	codes1, codes2 = encodeSeq(seq1), encodeSeq(seq2)
+	nb1, nb2 = max(1, -(-n // block)), max(1, -(-m // block))
+
+	rows_buf = multiprocessing.RawArray('i', (nb1+1) * (m+1))
+	cols_buf = multiprocessing.RawArray('i', (nb2+1) * (n+1))
+	rows = numpy.frombuffer(rows_buf, numpy.int32).reshape(nb1+1, m+1)
+	cols = numpy.frombuffer(cols_buf, numpy.int32).reshape(nb2+1, n+1)
+	rows[0] = -gap_pen * numpy.arange(m+1)
+	cols[0] = -gap_pen * numpy.arange(n+1)
+	rows[:, 0] = -gap_pen * numpy.minimum(numpy.arange(nb1+1) * block, n)
+	cols[:, 0] = -gap_pen * numpy.minimum(numpy.arange(nb2+1) * block, m)
+
+	initargs = (codes1, codes2, rows_buf, cols_buf, block, subst_matrix,
+		gap_pen)
+	if procs == 1:
+		_wavefrontInit(*initargs)
+		pool = None
+	else:
+		pool = multiprocessing.Pool(procs, _wavefrontInit, initargs)
+	try:
+		# tiles on one anti-diagonal are independent; map() returning is the
+		# barrier before the next one
+		for d in xrange(nb1 + nb2 - 1):
+			tiles = [(bi, d - bi) for bi in xrange(max(0, d - nb2 + 1),
+				min(d, nb1 - 1) + 1)]
+			if pool is None:
+				map(_wavefrontTile, tiles)
+			else:
+				pool.map(_wavefrontTile, tiles, 1)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+
+	TB = CheckpointTB(codes1, codes2, rows, cols, block, subst_matrix, gap_pen)
+	return int(rows[nb1, m]), None, TB
+
+###############################################################################
+# ALIGNMENT CACHE
+# Results are stored on disk, one small file per key, under a directory that
+# any number of processes may share. The key is a digest of everything the
+# result depends on: both sequences, S, gap_pen and how they were aligned.
+# A file is written under a temporary name and renamed into place, so
+# readers only ever see complete entries. Reads bump the file's mtime, and
+# once the entries add up to more than max_bytes the least recently used
+# ones are deleted, down to CACHE_LOW_WATER of max_bytes. The directory is
+# only scanned when the size seen at the last scan plus what this process
+# wrote since exceeds max_bytes, so puts do not stat every entry; with P
+# processes writing, the directory can overshoot by about P times the
+# headroom. Small parameter records (see significance) live in the
+# same directory but are never evicted.
+###############################################################################
+
+# default size limit of an AlignmentCache
+CACHE_MAX_BYTES = 256 * 2**20
+
+# fraction of max_bytes an eviction shrinks the entries to
+CACHE_LOW_WATER = 0.75
+
+def cacheKey(seq1,seq2,subst_matrix,gap_pen,mode):
+	"""return the hex digest identifying an alignment of seq1 and seq2"""
+	matrix = repr([[int(x) for x in row] for row in subst_matrix])
+	digest = hashlib.sha1()
+	for part in (mode, matrix, str(gap_pen), seq1, seq2):
+		digest.update("%d:%s" % (len(part), part))
+	return digest.hexdigest()
+
+class AlignmentCache:
+	"""directory of (score, distance, ops) results, evicted least recently
+	   used first once they add up to more than max_bytes
+	"""
+	def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		# size of the entries at the last scan plus those written since by
+		# this process, None before the first scan
+		self.size = None
+		try:
+			os.makedirs(directory)
+		except OSError:
+			if not os.path.isdir(directory):
+				raise
+
+	def path(self, key):
+		return os.path.join(self.directory, key + ".aln")
+
+	def get(self, key):
+		"""return the (score, distance, ops) stored under key, with ops None
+		   if only the score was stored, or None if there is no entry
+		"""
+		path = self.path(key)
+		try:
+			with open(path) as stream:
+				header, cigar = stream.read().split("\n")[:2]
+			os.utime(path, None)
+		except (IOError, OSError, ValueError):
+			# missing, or evicted by another process while we read it
+			return None
+		score, distance = [int(x) for x in header.split()]
+		ops = None if cigar == "*" else cigarToOps(cigar)
+		return score, distance, ops
+
+	def put(self, key, score, distance, ops=None):
+		"""store a result under key (ops None to store only the score)"""
+		text = "%d %d\n%s\n" % (score, distance,
+			"*" if ops is None else opsToCigar(ops))
+		self.write(self.path(key), text)
+		if self.size is not None:
+			self.size += len(text)
+		if self.size is None or self.size > self.max_bytes:
+			self.evict()
+
+	def getParams(self, key):
+		"""return the list of floats stored under key by putParams, or None;
+		   these are not subject to eviction
+		"""
+		try:
+			with open(os.path.join(self.directory, key + ".par")) as stream:
+				return [float(x) for x in stream.read().split()]
+		except (IOError, OSError, ValueError):
+			return None
+
+	def putParams(self, key, values):
+		self.write(os.path.join(self.directory, key + ".par"),
+			" ".join(repr(float(x)) for x in values) + "\n")
+
+	def write(self, path, text):
+		"""atomically replace the file at path with text"""
+		fd, tmp = tempfile.mkstemp(".tmp", "", self.directory)
+		with os.fdopen(fd, "w") as stream:
+			stream.write(text)
+		os.rename(tmp, path)
+
+	def evict(self):
+		"""if the entries add up to more than max_bytes, delete the least
+		   recently used ones down to CACHE_LOW_WATER of it; skipped if
+		   another process is already evicting
+		"""
+		lock = open(os.path.join(self.directory, ".lock"), "w")
+		try:
+			fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			lock.close()
+			return
+		try:
+			entries = []
+			for name in os.listdir(self.directory):
+				if not name.endswith(".aln"):
+					continue
+				try:
+					st = os.stat(os.path.join(self.directory, name))
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, name))
+			total = sum(size for mtime, size, name in entries)
+			if total > self.max_bytes:
+				entries.sort()
+				for mtime, size, name in entries:
+					if total <= self.max_bytes * CACHE_LOW_WATER:
+						break
+					try:
+						os.remove(os.path.join(self.directory, name))
+					except OSError:
+						pass
+					total -= size
+			self.size = total
+		finally:
+			lock.close()
+
+###############################################################################
+# SIGNIFICANCE
+# How surprising is score_xy? seq2 is shuffled many times keeping its
+# dinucleotide counts (Altschul-Erickson: a random Eulerian walk through its
+# base-to-next-base edges), seq1 is scored against each shuffle with
+# seqalignScore on a process pool, and an extreme value (Gumbel)
+# distribution is fitted to those scores by moments. In Karlin-Altschul
+# terms lambda = 1/beta and K m n = exp(mu/beta), so
+#   E = exp(-(score - mu) / beta),  p = 1 - exp(-E)
+# The fitted (mu, beta) depend mostly on the lengths, so they are cached per
+# pair of length buckets, S and gap_pen.
+###############################################################################
+
+# default number of shuffles
+SIGNIFICANCE_SHUFFLES = 200
+
+# lengths within a factor of this share cached Gumbel parameters
+LENGTH_BUCKET = 1.1
+
+EULER_GAMMA = 0.5772156649015329
+
+# (seq1, seq2, subst_matrix, gap_pen) being shuffled, set in each worker
+_significance = None
+
+def dinucleotideShuffle(seq,rng=random):
+	"""return a random permutation of seq with the same first base, last
+	   base and count of every pair of adjacent bases
+	"""
+	if len(seq) < 3:
+		return seq
+	edges = {}
+	for a, b in itertools.izip(seq, seq[1:]):
+		edges.setdefault(a, []).append(b)
+	last = seq[-1]
+
+	# the last edge out of every other base must form a tree into the last
+	# base, or the walk would get stuck before using all edges
+	while True:
+		exits = dict((a, rng.choice(edges[a])) for a in edges if a != last)
+		tree = True
+		for a in exits:
+			steps = 0
+			while a != last and steps <= len(exits):
+				a = exits[a]
+				steps += 1
+			tree = tree and a == last
+		if tree:
+			break
+
+	for a in edges:
+		if a in exits:
+			edges[a].remove(exits[a])
+		rng.shuffle(edges[a])
+		if a in exits:
+			edges[a].append(exits[a])
+
+	walk = dict((a, iter(edges[a])) for a in edges)
+	out = [seq[0]]
+	for k in xrange(len(seq) - 1):
+		out.append(walk[out[-1]].next())
+	return "".join(out)
+
+def _significanceInit(seq1,seq2,subst_matrix,gap_pen):
+	global _significance
+	_significance = (seq1, seq2, subst_matrix, gap_pen)
+
+def _shuffleScore(seed):
+	seq1, seq2, subst_matrix, gap_pen = _significance
+	shuffled = dinucleotideShuffle(seq2, random.Random(seed))
+	return seqalignScore(seq1,shuffled,subst_matrix,gap_pen)
+
+def shuffleScores(seq1,seq2,subst_matrix,gap_pen,shuffles=SIGNIFICANCE_SHUFFLES,
+		procs=None,seed=0):
+	"""return the scores of seq1 against shuffles dinucleotide shuffles of
+	   seq2, computed on procs processes (in this process if procs == 1)
+	"""
+	seeds = range(seed, seed + shuffles)
+	if procs == 1:
+		_significanceInit(seq1,seq2,subst_matrix,gap_pen)
+		return map(_shuffleScore, seeds)
+	procs = procs or multiprocessing.cpu_count()
+	pool = multiprocessing.Pool(procs, _significanceInit,
+		(seq1, seq2, subst_matrix, gap_pen))
+	try:
+		return pool.map(_shuffleScore, seeds, max(1, shuffles // (4 * procs)))
+	finally:
+		pool.terminate()
+		pool.join()
+
+def fitGumbel(scores):
+	"""return the (mu, beta) of the Gumbel distribution with the mean and
+	   variance of scores
+	"""
+	scores = numpy.asarray(scores, numpy.float64)
+	beta = numpy.sqrt(6) * scores.std() / numpy.pi
+	return float(scores.mean() - EULER_GAMMA * beta), float(beta)
+
+def gumbelEvalue(score,mu,beta):
+	"""return (E, p) of score under the Gumbel distribution (mu, beta)"""
+	if beta == 0:
+		E = 0.0 if score > mu else float("inf")
+	else:
+		E = math.exp(min(-(score - mu) / beta, 700.0))
+	return E, -math.expm1(-E)
+
+def significance(seq1,seq2,score,subst_matrix,gap_pen,
+		shuffles=SIGNIFICANCE_SHUFFLES,procs=None,cache=None):
+	"""return (E, p) of the global alignment score of seq1 and seq2; the
+	   Gumbel fit is read from, or stored in, cache (an AlignmentCache) if
+	   given
+	"""
+	buckets = [int(round(math.log(max(len(seq), 1), LENGTH_BUCKET)))
+		for seq in (seq1, seq2)]
+	key = cacheKey("", "", subst_matrix, gap_pen,
+		"gumbel %d %d %d" % (buckets[0], buckets[1], shuffles))
+	params = cache.getParams(key) if cache is not None else None
+	if params is None:
+		params = fitGumbel(shuffleScores(seq1,seq2,subst_matrix,gap_pen,
+			shuffles,procs))
+		if cache is not None:
+			cache.putParams(key, params)
+	mu, beta = params
+	return gumbelEvalue(score,mu,beta)
 
 S = [
 	# A  G   C   T
@@ -98,29 +1635,229 @@ S = [
 	]
 gap_pen = 4
 
+def writeOps(seq1,seq2,ops,options):
+	"""print an alignment in the output format selected on the command line"""
+	if options.format == "cigar":
+		print opsToCigar(ops)
+	else:
+		writeAlignment(seq1,seq2,ops,sys.stdout,options.width)
+
+def cacheMode(mode,options):
+	"""return the part of a cache key describing how the command line aligns:
+	   every exact global mode gives the same score and alignment
+	"""
+	if options.score_only or mode in ("full", "hirschberg"):
+		return "global"
+	if mode == "banded":
+		return "banded %s %s" % (options.band, options.mem_budget)
+	return "anchored %d" % options.kmerlen
+
+def alignMode(seq1,seq2,mode,align,options):
+	"""return (score_xy, ops) of the global alignment selected on the command
+	   line; ops is None with --score-only and score_xy is None if the fill
+	   was abandoned below --min-score
+	"""
+	min_score = options.min_score
+	ops = None
+	if options.score_only:
+		score_xy = seqalignScore(seq1,seq2,S,gap_pen,min_score)
+	elif mode == "full":
+		score_xy, F, TB = align(seq1,seq2,S,gap_pen)
+		if score_xy is not None:
+			ops = tracebackOps(seq1,seq2,TB)
+	elif mode == "banded":
+		if options.band is None:
+			max_width = bandMaxWidth(seq1,seq2,options.mem_budget * 2**20)
+			score_xy, F, TB, width = seqalignBandedAdaptive(seq1,seq2,S,gap_pen,
+				min(BAND_START, max_width), max_width)
+		else:
+			width = options.band
+			score_xy, F, TB = seqalignBanded(seq1,seq2,S,gap_pen,width)
+		if not bandIsOptimal(seq1,seq2,S,gap_pen,width,score_xy):
+			print >> sys.stderr, "warning: band width %d not proven optimal" % width
+		ops = tracebackOps(seq1,seq2,TB)
+	elif mode == "anchored":
+		score_xy, s1, s2 = anchoredAlign(seq1,seq2,S,gap_pen,options.kmerlen,
+			options.mem_budget * 2**20)
+		ops = stringsToOps(s1,s2)
+	else:
+		score_xy, s1, s2 = hirschberg(seq1,seq2,S,gap_pen)
+		ops = stringsToOps(s1,s2)
+	return score_xy, ops
+
 def main():
-    # parse commandline
-	if len(sys.argv) < 3:
+	# parse commandline
+	parser = optparse.OptionParser(
+		usage="python ps1-seqalign.py [options] <FASTA 1> <FASTA 2>\n"
+		      "       python ps1-seqalign.py --batch [options] <FASTA>")
+	parser.add_option("--mode",
+		choices=["auto", "full", "hirschberg", "banded", "local", "anchored",
+			"sw"],
+		default="auto",
+		help="full: seqalignDP tables, hirschberg: linear memory, "
+		     "banded: band around the diagonal (near-identical sequences), "
+		     "local: seed-and-extend local alignments from k-mer hits, "
+		     "anchored: global alignment through chained k-mer anchors, "
+		     "sw: best local alignment score and coordinates only, for "
+		     "every record of FASTA 2, "
+		     "auto: hirschberg when the tables exceed --mem-budget (default)")
+	parser.add_option("--band", type="int", default=None,
+		help="fixed band width for --mode banded; by default the width "
+		     "doubles until the banded score is provably optimal")
+	parser.add_option("--engine",
+		choices=["numpy", "packed", "wavefront", "python"], default="numpy",
+		help="fill the full tables with seqalignDPNumpy (numpy, default), "
+		     "seqalignDPNumpy with a 2-bit PackedTB (packed), "
+		     "wavefrontAlign tiles on --procs processes (wavefront) "
+		     "or seqalignDP (python)")
+	parser.add_option("--block", type="int", default=WAVEFRONT_BLOCK,
+		help="tile side for --engine wavefront [%default]")
+	parser.add_option("--mem-budget", type="float", default=1024,
+		help="memory budget in MB for the DP tables [%default]")
+	parser.add_option("--score-only", action="store_true", default=False,
+		help="only compute the distance, with two DP rows and no traceback")
+	parser.add_option("--kmerlen", type="int", default=SEED_KMERLEN,
+		help="k-mer length for --mode local and anchored [%default]")
+	parser.add_option("--skip", type="int", default=1,
+		help="spaced seed: use every skip-th base of each k-mer [%default]")
+	parser.add_option("--xdrop", type="int", default=SEED_XDROP,
+		help="X-drop for the gapped extension in --mode local [%default]")
+	parser.add_option("--min-score", type="int", default=None,
+		help="only report alignments scoring at least this; in --mode local "
+		     "it filters the local alignments [0], otherwise the global "
+		     "fill is abandoned as soon as score_xy cannot reach it and the "
+		     "distance is printed as NA")
+	parser.add_option("--max-extend", type="int", default=SEED_MAX_EXTEND,
+		help="longest X-drop extension beyond a chain in --mode local [%default]")
+	parser.add_option("--lanes", type="int", default=SW_LANES,
+		help="FASTA 2 records filled together in --mode sw [%default]")
+	parser.add_option("--format", choices=["strings", "cigar"],
+		default="strings",
+		help="print the alignment as gapped strings (default) or as a CIGAR "
+		     "string of M/I/D runs with seq1 as the reference")
+	parser.add_option("--width", type="int", default=0,
+		help="write the gapped strings in blocks of this many columns "
+		     "instead of two lines")
+	parser.add_option("--batch", action="store_true", default=False,
+		help="compute the distance matrix of all record pairs of a single "
+		     "multi-record FASTA instead of aligning two files")
+	parser.add_option("--procs", type="int", default=None,
+		help="worker processes for --batch and --engine wavefront "
+		     "[number of cores]")
+	parser.add_option("--out", default=None,
+		help="write the --batch distance matrix to this file [stdout]")
+	parser.add_option("--max-edit", type="int", default=None,
+		help="in --batch, only align pairs within this edit distance "
+		     "(bit-parallel pre-filter) and write NA for the rest")
+	parser.add_option("--max-distance", type="int", default=None,
+		help="in --batch, abandon pairs as soon as their distance must "
+		     "exceed this and write NA for them")
+	parser.add_option("--significance", type="int", default=0, metavar="N",
+		help="also print the E-value and p-value of score_xy, from a Gumbel "
+		     "fit to N dinucleotide shuffles of seq2 (on --procs processes)")
+	parser.add_option("--cache", default=None, metavar="DIR",
+		help="reuse global alignment results stored in DIR, and store new "
+		     "ones there (also for --batch)")
+	parser.add_option("--cache-size", type="float",
+		default=CACHE_MAX_BYTES / 2**20, help="size limit of the --cache directory in MB [%default]")
+	options, args = parser.parse_args()
+
+	cache = None
+	if options.cache:
+		cache = AlignmentCache(options.cache, options.cache_size * 2**20)
+
+	if options.batch:
+		if len(args) != 1:
+			print "you must call program as: python ps1-seqalign.py --batch <FASTA>"
+			sys.exit(1)
+		records = readFasta(args[0])
+		D = pairDistances([seq for name, seq in records],S,gap_pen,
+			options.procs,max_edit=options.max_edit,
+			max_distance=options.max_distance,cache=cache)
+		stream = open(options.out, "w") if options.out else sys.stdout
+		writeDistanceMatrix([name for name, seq in records],D,stream)
+		return
+
+	if len(args) < 2:
 		print "you must call program as: python ps1-seqalign.py <FASTA 1> <FASTA 2>"
 		sys.exit(1)
 
-	file1 = sys.argv[1]
-	file2 = sys.argv[2]
+	file1 = args[0]
+	file2 = args[1]
 
 	seq1 = readSeq(file1)
 	seq2 = readSeq(file2)
 
+	if options.mode == "local":
+		lookup = buildIndex(seq1, options.kmerlen, options.skip)
+		hits = findHits(lookup, seq2, options.kmerlen, options.skip,
+			inversions=False)
+		alignments = seedExtend(seq1, seq2, hits, options.kmerlen, S, gap_pen,
+			options.xdrop, options.min_score or 0, options.max_extend)
+		for score, start1, end1, start2, end2, s1, s2 in alignments:
+			print "%d\t%d\t%d\t%d\t%d" % (score, start1, end1, start2, end2)
+			writeOps(seq1[start1:end1], seq2[start2:end2], stringsToOps(s1,s2),
+				options)
+		return
+
+	if options.mode == "sw":
+		seqs = [seq for name, seq in readFasta(file2)]
+		for result in swScores(seq1,seqs,S,gap_pen,options.lanes):
+			print "%d\t%d\t%d\t%d\t%d" % result
+		return
+
+	min_score = options.min_score
+	if options.engine == "numpy":
+		align = lambda seq1, seq2, S, gap_pen: \
+			seqalignDPNumpy(seq1, seq2, S, gap_pen, min_score=min_score)
+		cell_bytes = NUMPY_CELL_BYTES
+	elif options.engine == "packed":
+		align = lambda seq1, seq2, S, gap_pen: \
+			seqalignDPNumpy(seq1, seq2, S, gap_pen, packed=True,
+				min_score=min_score)
+		cell_bytes = PACKED_CELL_BYTES
+	elif options.engine == "wavefront":
+		align = lambda seq1, seq2, S, gap_pen: \
+			wavefrontAlign(seq1, seq2, S, gap_pen, options.block, options.procs)
+		# only the int32 checkpoint rows and columns are kept
+		cell_bytes = 8.0 / options.block
+	else:
+		align, cell_bytes = seqalignDP, DP_CELL_BYTES
+
+	mode = options.mode
+	if mode == "auto":
+		if dpTableBytes(seq1,seq2,cell_bytes) <= options.mem_budget * 2**20:
+			mode = "full"
+		else:
+			mode = "hirschberg"
+
+	cached = None
+	if cache is not None:
+		key = cacheKey(seq1,seq2,S,gap_pen,cacheMode(mode,options))
+		cached = cache.get(key)
+	if cached is not None and (options.score_only or cached[2] is not None):
+		score_xy, distance, ops = cached
+	else:
+		score_xy, ops = alignMode(seq1,seq2,mode,align,options)
+		if score_xy is not None:
+			sxx = selfScore(seq1,S,gap_pen)
+			syy = selfScore(seq2,S,gap_pen)
+			distance = max(sxx, syy) - score_xy
+			if cache is not None:
+				cache.put(key,score_xy,distance,ops)
 
-	score_xy, F, TB = seqalignDP(seq1,seq2,S,gap_pen)
-	sxx = seqalignDP(seq1,seq1,S,gap_pen)[0]
-	syy = seqalignDP(seq2,seq2,S,gap_pen)[0]
-	distance = max(sxx, syy) - score_xy
+	if score_xy is None or min_score is not None and score_xy < min_score:
+		print >> sys.stderr, "NA"
+		return
 
 	print >> sys.stderr, distance
+	if options.significance:
+		E, p = significance(seq1,seq2,score_xy,S,gap_pen,options.significance,
+			options.procs,cache)
+		print >> sys.stderr, "E-value %.3g p-value %.3g" % (E, p)
 
-	s1, s2 = traceback(seq1,seq2,TB)
-	print s1
-	print s2
+	if not options.score_only:
+		writeOps(seq1,seq2,ops,options)
 
 if __name__ == "__main__":
 	main()
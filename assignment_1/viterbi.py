@@ -1,6 +1,7 @@
 import sys
 from math import log
 from util import plothist
+from packedseq import encodeSeq
 
 ###############################################################################
 # HMM PARAMETERS
@@ -161,10 +162,8 @@ def main():
     if X[len(X)-1] == '\n': X=X[0:len(X)-1]
     if refanno[len(refanno)-1] == '\n': refanno=refanno[0:len(refanno)-1]
 
-    X=list(X)
+    X = encodeSeq(X).tolist()
     refanno=list(refanno)
-    for i in xrange(len(X)):
-        X[i] = base_idx[X[i]]
     for i in xrange(len(refanno)):
         refanno[i] = state_idx[refanno[i]]
 